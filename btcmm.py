@@ -2,19 +2,28 @@
 import asyncio
 from coinbots.strategy import Strategy
 from coinbots.indicator import *
+from coinbots.incremental import Stdev, Change
 from time import time
 
 class btcmm:
+    def __init__(self, devlen=10, devmaxlen=1000, maxsize=0.005):
+        # 足の確定ごとに逐次計算するインジケーター
+        self.indicators = {
+            'dev': Stdev('close',devlen),
+            'devmax': Stdev(Change('close',devlen),devmaxlen),
+        }
+        self.maxsize = maxsize
+
     async def run(self, ohlcv, strategy, **others):
         C = ohlcv.close.values[-1]
-        dev = stdev(ohlcv.close,10).values[-1]
-        devmax = stdev(change(ohlcv.close,10),1000).values[-1]
+        dev = ohlcv.dev.values[-1]
+        devmax = ohlcv.devmax.values[-1]
         target = max(dev,devmax)
         mid = C
         buylimit = mid-target
         selllimit = mid+target
 
-        maxsize = 0.005
+        maxsize = self.maxsize
         delta_pos = strategy.position_size-maxsize
         buysize = min(maxsize-delta_pos,maxsize)
         sellsize = min(maxsize+delta_pos,maxsize)
@@ -24,14 +33,22 @@ class btcmm:
         if delta_pos<0 and delta_pos>-0.005:
             buysize -= delta_pos
 
+        quotes = []
         if buysize>=0.005:
-            await strategy.order('L','buy',size=buysize,limit=buylimit)
-        else:
-            await strategy.cancel('L')
+            quotes.append(dict(myid='L',side='buy',size=buysize,limit=buylimit))
         if sellsize>=0.005:
-            await strategy.order('S','sell',size=sellsize,limit=selllimit)
-        else:
-            await strategy.cancel('S')
+            quotes.append(dict(myid='S',side='sell',size=sellsize,limit=selllimit))
+        await strategy.set_quotes(quotes)
+
+def create_strategy(interval=1, minimum_interval=5, **params):
+    logic = btcmm(**params)
+    strategy = Strategy(yourlogic=logic.run, interval=interval)
+    strategy.settings.symbol = 'BTC/JPY'
+    strategy.settings.indicators = logic.indicators
+    strategy.settings.minimum_interval = minimum_interval
+    strategy.settings.concurrent_requote = True
+    strategy.settings.max_exposure = 0.02
+    return strategy
 
 if __name__ == "__main__":
     import settings
@@ -42,11 +59,9 @@ if __name__ == "__main__":
     listener.start()
     logger = logging.getLogger("btcmm")
 
-    strategy = Strategy(yourlogic=btcmm().run, interval=1)
-    strategy.settings.symbol = 'BTC/JPY'
+    strategy = create_strategy()
     strategy.settings.apiKey = settings.apiKey
     strategy.settings.secret = settings.secret
-    strategy.settings.minimum_interval = 5
 
     loop = asyncio.get_event_loop()
     try:
@@ -6,21 +6,119 @@ import time
 import hmac
 import hashlib
 import urllib.parse
+from heapq import heappush, heappop
+from collections import defaultdict
 from datetime import datetime, timedelta
+from .tracing import tracer
 
 class CCAPI:
 
-    def __init__(self, apiKey='', secret=''):
+    # 優先度 (小さいほど優先)
+    PRIORITY_CANCEL = 0
+    PRIORITY_ORDER = 1
+    PRIORITY_QUERY = 2
+    PRIORITY_POLLING = 3
+
+    # グループごとの (1秒あたりのリクエスト数, バースト数)
+    # 注文・取消も含めプライベートAPIは一つの制限を共有するので、同じバケットで優先度順に待たせる
+    RATE_LIMITS = {
+        'public': (10, 10),
+        'private': (5, 5),
+    }
+
+    class TokenBucket:
+        """優先度付き待ち行列を持つトークンバケット"""
+
+        def __init__(self, rate, capacity):
+            self.rate = rate
+            self.capacity = capacity
+            self.tokens = capacity
+            self.updated = time.monotonic()
+            self.waiters = []
+            self.seq = 0
+            self.task = None
+            self.max_queue_depth = 0
+            self.lanes = defaultdict(lambda:{'count':0,'wait_total':0.0,'wait_max':0.0})
+
+        def _refill(self):
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+        def _record(self, priority, wait):
+            lane = self.lanes[priority]
+            lane['count'] += 1
+            lane['wait_total'] += wait
+            lane['wait_max'] = max(lane['wait_max'], wait)
+
+        async def acquire(self, priority):
+            self._refill()
+            if len(self.waiters)==0 and self.tokens >= 1:
+                self.tokens -= 1
+                self._record(priority, 0)
+                return
+            start = time.monotonic()
+            fut = asyncio.get_event_loop().create_future()
+            heappush(self.waiters, (priority, self.seq, fut))
+            self.seq += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self.waiters))
+            if self.task is None or self.task.done():
+                self.task = asyncio.ensure_future(self._drain())
+            await fut
+            self._record(priority, time.monotonic() - start)
+
+        async def _drain(self):
+            while len(self.waiters):
+                self._refill()
+                if self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                    continue
+                _, _, fut = heappop(self.waiters)
+                if fut.done():
+                    continue
+                self.tokens -= 1
+                fut.set_result(True)
+
+        def stats(self):
+            return {
+                'queue_depth':len(self.waiters),
+                'max_queue_depth':self.max_queue_depth,
+                'lanes':{p:dict(lane, wait_mean=lane['wait_total']/lane['count'] if lane['count'] else 0)
+                    for p, lane in sorted(self.lanes.items())},
+            }
+
+    def __init__(self, apiKey='', secret='', rate_limits=None):
         self.apiKey = apiKey
         self.secret = secret
         self.endpoint = 'https://coincheck.com'
         self.session = aiohttp.ClientSession()
-
-    async def throttle(self):
-        pass
-
-    async def fetch(self, method, path, params=None):
-        await self.throttle()
+        limits = dict(CCAPI.RATE_LIMITS, **(rate_limits or {}))
+        self.buckets = {group:CCAPI.TokenBucket(rate, capacity) for group, (rate, capacity) in limits.items()}
+
+    @staticmethod
+    def classify(method, path):
+        """リクエストのグループと既定の優先度"""
+        if path == '/api/exchange/orders' and method == 'POST':
+            return 'private', CCAPI.PRIORITY_ORDER
+        if path.startswith('/api/exchange/orders/') and method == 'DELETE':
+            return 'private', CCAPI.PRIORITY_CANCEL
+        if path in ('/api/exchange/orders/opens', '/api/exchange/orders/cancel_status'):
+            return 'private', CCAPI.PRIORITY_QUERY
+        if path.startswith('/api/exchange/orders') or path.startswith('/api/accounts'):
+            return 'private', CCAPI.PRIORITY_POLLING
+        return 'public', CCAPI.PRIORITY_QUERY
+
+    async def throttle(self, method, path, priority=None):
+        group, default_priority = CCAPI.classify(method, path)
+        bucket = self.buckets.get(group)
+        if bucket:
+            await bucket.acquire(default_priority if priority is None else priority)
+
+    def throttle_stats(self):
+        return {group:bucket.stats() for group, bucket in self.buckets.items()}
+
+    async def fetch(self, method, path, params=None, priority=None):
+        await self.throttle(method, path, priority)
         return await self.fetch2(method, path, params)
 
     async def fetch2(self, method, path, params):
@@ -45,12 +143,19 @@ class CCAPI:
             headers['ACCESS-KEY'] = apiKey
             headers['ACCESS-NONCE'] = nonce
             headers['ACCESS-SIGNATURE'] = sign
+        if tracer.enabled:
+            start = time.perf_counter()
         async with self.session.request(method=method,url=url,params=params,data=data,headers=headers) as res:
             # http_response = await res.text()
             # http_status_code = res.status
             # http_status_text = res.reason
             # print(res.headers)
             json_response = await res.json()
+        if tracer.enabled:
+            tracer.record('fetch2', time.perf_counter()-start)
+            if method == 'POST' and path == '/api/exchange/orders':
+                # 約定受信から注文受付まで
+                tracer.since('recv_to_ack','logic_recv')
         return json_response
 
     async def ticker(self, **kwargs):
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import json
+import numpy as np
+from collections import defaultdict
+from datetime import datetime, timezone
+from time import perf_counter
+from .utils import dotdict
+from .streaming import Streaming
+from .exchange import Exchange, ExchangeError
+from .clock import SimClock
+
+class Backtest:
+    """記録した約定で Strategy のロジックを動かすバックテスト
+
+    Strategy の standard_logic などのタスクを SimClock で実時間より速く動かし、
+    実運用と同じ引数で yourlogic を呼ぶ。発注・キャンセルは SimulatedExchange に送られ、
+    発注後の約定で約定判定した結果を Inventory に反映する。
+    """
+
+    class SimulatedExchange:
+        """Exchange互換の模擬取引所
+
+        指値注文は、発注後の約定が指値を越えた分だけ指値で約定する
+        (fill_at_touch なら指値と同値の約定も対象)。
+        複数の注文が同じ約定を取り合うことは考慮しない。
+        """
+
+        def __init__(self, pair, clock, fee=0.0, fill_at_touch=False, initial_balance=None):
+            self.logger = logging.getLogger(__name__)
+            self.clock = clock
+            self.pair = pair
+            self.spec = Exchange.ProductSpecs[pair]
+            self.base, self.quote = pair.split('_')
+            self.fee = fee
+            self.fill_at_touch = fill_at_touch
+            self.book = {}
+            self.transactions = []
+            self.funds = defaultdict(float, initial_balance or {})
+            self.last_order_id = 0
+            self.last_trade_id = 0
+            self.stats = dotdict({'orders':0,'cancels':0,'fills':0,'turnover':0.0,'fees':0.0})
+
+        def _timestamp(self):
+            return datetime.fromtimestamp(self.clock.time(), timezone.utc).isoformat()
+
+        async def order(self, pair, side, amount, rate, stop_loss_rate=None):
+            amount = self.spec.round_amount(amount)
+            rate = self.spec.round_price(rate)
+            self.last_order_id += 1
+            self.stats.orders += 1
+            o = {
+                'id':self.last_order_id,
+                'rate':rate,
+                'amount':amount,
+                'order_type':side,
+                'stop_loss_rate':stop_loss_rate,
+                'pair':pair,
+                'created_at':self._timestamp(),
+            }
+            self.book[o['id']] = dotdict({'id':o['id'],'side':side,'rate':rate,'amount':amount,'remaining':amount})
+            o['executed_amount'] = 0
+            o['status'] = 'open'
+            return o
+
+        async def cancel(self, orderRes):
+            orderRes['status'] = 'cancelling'
+            if self.book.pop(orderRes['id'], None) is None:
+                raise ExchangeError(f'order not found in cancel with {orderRes["pair"]} {orderRes["id"]}')
+            self.stats.cancels += 1
+            orderRes['status'] = 'cancel'
+            return orderRes
+
+        async def cancel_status(self, order_id):
+            return {'id':order_id,'cancel':order_id not in self.book,'created_at':self._timestamp()}
+
+        async def get_orders(self, pair=None):
+            return [{'id':o.id,'order_type':o.side,'rate':o.rate,'pair':self.pair,'pending_amount':o.remaining,
+                'pending_market_buy_amount':None,'stop_loss_rate':None,'created_at':self._timestamp()}
+                for o in self.book.values()]
+
+        async def get_my_trades(self, pair=None, count=None, since=None, end=None, order=None):
+            # 取引IDは1からの連番なので位置で切り出す
+            trades = self.transactions[since or 0:]
+            if end:
+                trades = trades[:max(end - 1 - (since or 0), 0)]
+            if order != 'asc':
+                trades = trades[::-1]
+            return trades[:count or 25]
+
+        async def balance(self):
+            result = {}
+            for c in (self.base, self.quote):
+                result[c] = self.funds[c]
+                result[c+'_reserved'] = 0.0
+            return result
+
+        async def orderbooks(self, pair):
+            return {'asks':[],'bids':[]}
+
+        def match(self, batch):
+            """約定バッチで板に残っている注文を約定させ、取引履歴を返す"""
+            fills = []
+            if len(batch) == 0:
+                return fills
+            for o in list(self.book.values()):
+                if o.side == 'buy':
+                    crossed = batch.rate <= o.rate if self.fill_at_touch else batch.rate < o.rate
+                else:
+                    crossed = batch.rate >= o.rate if self.fill_at_touch else batch.rate > o.rate
+                index = np.flatnonzero(crossed)
+                if len(index) == 0:
+                    continue
+                # 約定を古い順に消化し、注文ごとに1件の取引にまとめる
+                cum = np.cumsum(batch.amount[index])
+                last = min(int(np.searchsorted(cum, o.remaining)), len(index)-1)
+                amount = self.spec.round_amount(min(o.remaining, float(cum[last])))
+                if amount <= 0:
+                    continue
+                o.remaining = self.spec.round_amount(o.remaining - amount)
+                if o.remaining <= 0:
+                    del self.book[o.id]
+                fills.append(self._execute(o, amount, float(batch.time[index[last]])))
+            self.transactions.extend(fills)
+            return fills
+
+        def _execute(self, o, amount, t):
+            self.last_trade_id += 1
+            notional = amount * o.rate
+            fee = notional * self.fee
+            sign = 1 if o.side == 'buy' else -1
+            funds = {self.base:sign*amount, self.quote:-sign*notional-fee}
+            for c, v in funds.items():
+                self.funds[c] += v
+            self.stats.fills += 1
+            self.stats.turnover += notional
+            self.stats.fees += fee
+            return {
+                'id':self.last_trade_id,
+                'order_id':o.id,
+                'created_at':datetime.fromtimestamp(t, timezone.utc).isoformat(),
+                'funds':funds,
+                'pair':self.pair,
+                'rate':o.rate,
+                'fee_currency':self.quote.upper(),
+                'fee':fee,
+                'liquidity':'M',
+                'side':o.side,
+                'amount':amount,
+            }
+
+    class TradeFeed:
+        """約定履歴を時計に合わせて返すエンドポイント
+
+        get_data() は前回から現在時刻までの約定を返す。
+        """
+
+        def __init__(self, trades, clock, columnar=False):
+            self.trades = trades
+            self.clock = clock
+            self.columnar = columnar
+            self.pos = 0
+            self.count = 0
+
+        async def wait(self):
+            # 次の約定の時刻まで待つ
+            if self.pos < len(self.trades):
+                await self.clock.sleep(self.trades.time[self.pos] - self.clock.time())
+            else:
+                # 約定を使い切ったら返らない (interval=0 で空回りしないように)
+                await asyncio.get_event_loop().create_future()
+            return True
+
+        async def get_data(self, blocking=False):
+            hi = int(np.searchsorted(self.trades.time, self.clock.time(), side='right'))
+            batch = self.trades[self.pos:hi]
+            self.pos = hi
+            self.count += 1
+            return batch if self.columnar else batch.to_list()
+
+    def __init__(self, strategy, fee=0.0, fill_at_touch=False, initial_balance=None):
+        self.logger = logging.getLogger(__name__)
+        self.strategy = strategy
+        self.fee = fee
+        self.fill_at_touch = fill_at_touch
+        self.initial_balance = initial_balance
+
+    @staticmethod
+    def load_recording(path, pair='btc_jpy'):
+        """Streaming.Recorder のログから約定を TradeBatch として読み込む"""
+        ids, rates, amounts, sides, times = [], [], [], [], []
+        sides_map = Streaming.TradeBatch.SIDES
+        base = None
+        for t, kind, payload in Streaming.Recorder.read(path):
+            if kind == Streaming.Recorder.START:
+                # monotonic時刻を実時刻に換算
+                base = float(payload) - t
+                continue
+            if kind == Streaming.Recorder.SIO_TRADES:
+                channel, dat = Streaming.SocketioSource._parse_trades(json.loads(payload))
+            elif kind == Streaming.Recorder.WS_MESSAGE:
+                channel, dat = Streaming.WebsocketSource._parse_message(json.loads(payload))
+            else:
+                continue
+            if not channel.startswith(pair+'-trades'):
+                continue
+            for e in (dat if isinstance(dat,list) else [dat]):
+                ids.append(int(e['id']))
+                rates.append(e['rate'])
+                amounts.append(e['amount'])
+                sides.append(sides_map.get(e['order_type'],0))
+                times.append(t + (base or 0))
+        id = np.array(ids, np.int64)
+        # 重複(再接続時の補完など)を除いてID順に並べる
+        _, index = np.unique(id, return_index=True)
+        return Streaming.TradeBatch(
+            id[index],
+            np.array(rates, np.float64)[index],
+            np.array(amounts, np.float64)[index],
+            np.array(sides, np.int8)[index],
+            np.maximum.accumulate(np.array(times, np.float64)[index]) if len(index) else np.zeros(0))
+
+    @staticmethod
+    def random_trades(n, seconds, price=5000000, volatility=300, seed=0):
+        """動作確認用のランダムウォークの約定"""
+        rng = np.random.default_rng(seed)
+        return Streaming.TradeBatch(
+            np.arange(n, dtype=np.int64),
+            np.round(price + np.cumsum(rng.normal(0, volatility, n))),
+            np.round(rng.exponential(0.05, n), 8),
+            rng.choice(np.array([1,-1], np.int8), n),
+            np.sort(rng.uniform(0, seconds, n)))
+
+    def setup(self, pair):
+        strategy = self.strategy
+        strategy.pair = pair
+        strategy.spec = Exchange.ProductSpecs[pair]
+        strategy.api = Backtest.SimulatedExchange(pair, strategy.clock, self.fee, self.fill_at_touch, self.initial_balance)
+        strategy.board = None
+        strategy.settings.enable_board = False
+        strategy.settings.enable_board_api = False
+        strategy.setup()
+        # 約定は取引履歴から check_trades で取り込む (最初の取引から)
+        strategy.latest_trade_id = 0
+        if self.initial_balance:
+            strategy.inventory.balance.sync(self.initial_balance, pair.split('_'))
+
+    async def run(self, trades):
+        """trades: 時刻順の TradeBatch
+
+        Strategy の各タスクを SimClock 上で実際に動かし、全タスクが待ち状態に
+        なるたびに次の起床時刻まで時間を進める。進める前に、その間の約定で
+        板に残っている注文を約定判定する。
+        """
+        strategy = self.strategy
+        interval = strategy.settings.interval or 1
+        start = perf_counter()
+        first = np.floor(trades.time[0] / interval) * interval if len(trades) else 0
+        clock = SimClock(first)
+        strategy.clock = clock
+        self.setup(strategy.settings.symbol.replace('/','_').lower())
+        exchange = strategy.api
+        feed = Backtest.TradeFeed(trades, clock, strategy.settings.columnar_executions)
+        strategy.executions_ep = feed
+        tasks = [asyncio.ensure_future(c) for c in [
+            strategy.standard_logic(),
+            strategy.balance_polling(),
+            strategy.cancel_nonactive_orders(),
+            strategy.inventory.remove_nonactive_orders()]]
+        end = trades.time[-1] + interval if len(trades) else first
+        matched = 0
+        try:
+            while True:
+                await clock.settle()
+                when = clock.next_time()
+                if when is None or when > end:
+                    break
+                # 次の起床時刻までの約定で注文を約定判定
+                hi = int(np.searchsorted(trades.time, when, side='right'))
+                if hi > matched:
+                    fills = exchange.match(trades[matched:hi])
+                    matched = hi
+                    if len(fills):
+                        # 実運用と同じく取引履歴から取り込む (残高の二重計上を防ぐ)
+                        await strategy.check_trades()
+                clock.advance()
+            # 最後に残高を突き合わせる
+            await strategy.check_balance()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return self.results(feed.count, perf_counter() - start)
+
+    def results(self, ticks=0, elapsed=0):
+        strategy = self.strategy
+        exchange = strategy.api
+        position = strategy.inventory.position
+        last = strategy.ohlcvbuilder.last
+        unrealized = (last['rate'] - position.position_avg_price) * position.position_size if last and position.position_size else 0
+        return dotdict({
+            'netprofit':position.netprofit,
+            'unrealized':unrealized,
+            'pnl':position.netprofit + unrealized - exchange.stats.fees,
+            'position_size':position.position_size,
+            'orders':exchange.stats.orders,
+            'cancels':exchange.stats.cancels,
+            'fills':exchange.stats.fills,
+            'turnover':exchange.stats.turnover,
+            'fees':exchange.stats.fees,
+            'ticks':ticks,
+            'elapsed':elapsed,
+            'max_drift':dict(strategy.inventory.balance.max_drift),
+        })
+
+if __name__ == "__main__":
+    import argparse
+    import sys, os
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from btcmm import create_strategy
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', nargs='?', help='Streaming.Recorder のログ (省略時はランダムウォーク)')
+    parser.add_argument('--interval', type=float, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    if args.path:
+        trades = Backtest.load_recording(args.path)
+    else:
+        # 1日分 (約50万約定) のランダムウォーク
+        trades = Backtest.random_trades(500000, 86400)
+
+    strategy = create_strategy(interval=args.interval)
+    strategy.settings.columnar_executions = True
+    backtest = Backtest(strategy, initial_balance={'btc':1, 'jpy':10000000})
+    results = asyncio.get_event_loop().run_until_complete(backtest.run(trades))
+    print(f'{len(trades)} trades')
+    for k, v in results.items():
+        print(k, v)
+    # 模擬取引所と同じ約定を一度ずつ反映していれば残高のずれは出ない
+    assert strategy.inventory.balance.applied == results.fills, (strategy.inventory.balance.applied, results.fills)
+    assert all(abs(v) < 1e-6 for v in results.max_drift.values()), results.max_drift
+    print('balance drift ok')
@@ -1,59 +1,232 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import logging
+import numpy as np
+from bisect import bisect_left
+from time import time
 from .streaming import Streaming
-from .utils import stop_watch
+from .utils import stop_watch, dotdict
 from .cctypes import type_converter
 from .api import CCAPI
 
 class Board:
 
-    def __init__(self,pair):
+    class Ladder:
+        """価格順に整列した板の片側
+
+        levels は最良気配から並んだ {'price','size'} のリストで、
+        差分は二分探索で該当位置に挿入・更新・削除する。
+        """
+
+        def __init__(self, reverse=False):
+            self.sign = -1 if reverse else 1
+            self.keys = []
+            self.levels = []
+            self.index = {}
+            self._arrays = None
+
+        def clear(self):
+            self.keys.clear()
+            self.levels.clear()
+            self.index.clear()
+            self._arrays = None
+
+        def arrays(self):
+            """(prices, sizes, cumsizes) のNumPy配列 板が変わるまでキャッシュする"""
+            if self._arrays is None:
+                n = len(self.levels)
+                prices = np.fromiter((l['price'] for l in self.levels), np.float64, n)
+                sizes = np.fromiter((l['size'] for l in self.levels), np.float64, n)
+                self._arrays = (prices, sizes, np.cumsum(sizes))
+            return self._arrays
+
+        def set(self, price, size):
+            self._arrays = None
+            level = self.index.get(price)
+            if level is not None:
+                if size > 0:
+                    level['size'] = size
+                else:
+                    i = bisect_left(self.keys, price*self.sign)
+                    del self.keys[i]
+                    del self.levels[i]
+                    del self.index[price]
+            elif size > 0:
+                level = {'price':price,'size':size}
+                key = price*self.sign
+                i = bisect_left(self.keys, key)
+                self.keys.insert(i, key)
+                self.levels.insert(i, level)
+                self.index[price] = level
+
+    def __init__(self, pair, imbalance_levels=5, api=None):
+        self.logger = logging.getLogger(__name__)
         self.pair = pair
-        self.temp_bids = {}
-        self.temp_asks = {}
-        self.bids = []
-        self.asks = []
+        # 再同期用API (orderbooks(pair)を持つExchange)
+        self.api = api
+        self._bids = Board.Ladder(reverse=True)
+        self._asks = Board.Ladder()
+        self.bids = self._bids.levels
+        self.asks = self._asks.levels
+        # 最良気配
+        self.imbalance_levels = imbalance_levels
+        self.best_bid = self.best_ask = None
+        self.best_bid_size = self.best_ask_size = 0
+        self.bid_depth = self.ask_depth = 0
         self._updated = False
-        self._needs_sort = False
         self.cond = asyncio.Condition()
+        # 板の同期状態
+        self.cross_tolerance = 50
+        self.stale_seconds = 60
+        self.resync_interval = 5
+        self.health = dotdict({
+            'diffs':0,
+            'crossed':0,
+            'stale':0,
+            'resyncs':0,
+            'resync_errors':0,
+            'replayed_diffs':0,
+            'last_update':0,
+            'last_resync':0,
+        })
+        self._pending = None
         # self._create = stop_watch(self._create)
         # self._update = stop_watch(self._update)
-        # self.sort = stop_watch(self.sort)
 
     def _create(self, board):
-        self.temp_bids = {b[0]:b[1] for b in board['bids']}
-        self.temp_asks = {b[0]:b[1] for b in board['asks']}
-        self.bids = [{'price':k,'size':v} for k,v in self.temp_bids.items()]
-        self.asks = [{'price':k,'size':v} for k,v in self.temp_asks.items()]
+        self._bids.clear()
+        self._asks.clear()
+        self._update(board)
 
     def _update(self, board):
-        self.temp_bids.update({b[0]:b[1] for b in board['bids']})
-        self.temp_asks.update({b[0]:b[1] for b in board['asks']})
+        for b in board['bids']:
+            self._bids.set(b[0],b[1])
+        for b in board['asks']:
+            self._asks.set(b[0],b[1])
+        self._update_top()
+
+    def _update_top(self):
+        n = self.imbalance_levels
+        if len(self.bids):
+            self.best_bid = self.bids[0]['price']
+            self.best_bid_size = self.bids[0]['size']
+        else:
+            self.best_bid, self.best_bid_size = None, 0
+        if len(self.asks):
+            self.best_ask = self.asks[0]['price']
+            self.best_ask_size = self.asks[0]['size']
+        else:
+            self.best_ask, self.best_ask_size = None, 0
+        self.bid_depth = sum(b['size'] for b in self.bids[:n])
+        self.ask_depth = sum(a['size'] for a in self.asks[:n])
+
+    @property
+    def spread(self):
+        if self.best_bid is None or self.best_ask is None:
+            return None
+        return self.best_ask - self.best_bid
+
+    @property
+    def mid(self):
+        if self.best_bid is None or self.best_ask is None:
+            return None
+        return (self.best_bid + self.best_ask) / 2
+
+    @property
+    def microprice(self):
+        """最良気配の数量で加重した仲値"""
+        if self.best_bid is None or self.best_ask is None:
+            return None
+        total = self.best_bid_size + self.best_ask_size
+        return (self.best_bid*self.best_ask_size + self.best_ask*self.best_bid_size) / total
+
+    @property
+    def imbalance(self):
+        """上位 imbalance_levels 本の買い/売り数量の偏り(-1〜1)"""
+        total = self.bid_depth + self.ask_depth
+        if total == 0:
+            return 0
+        return (self.bid_depth - self.ask_depth) / total
 
     def sync(self, board):
         self._create(board)
         self._updated = True
-        self._needs_sort = False
+        self.health.last_update = time()
 
     async def attach(self, streaming):
         await streaming.subscribe_channel(self.pair+'-orderbook',self._orderbook)
+        if self.api:
+            asyncio.ensure_future(self._watch_stale())
 
     async def _orderbook(self, channel, board):
         async with self.cond:
             self._updated = True
-            self._needs_sort = True
             self._update(board)
+            self.health.diffs += 1
+            self.health.last_update = time()
+            if self._pending is not None:
+                # 再同期中の差分は取得後に再適用する
+                self._pending.append(board)
+            elif self.crossed:
+                self.health.crossed += 1
+                self.resync(f'crossed bid {self.best_bid} ask {self.best_ask}')
             self.cond.notify()
 
+    @property
+    def crossed(self):
+        spread = self.spread
+        return spread is not None and spread < -self.cross_tolerance
+
+    @property
+    def resyncing(self):
+        return self._pending is not None
+
+    def resync(self, reason=''):
+        """バックグラウンドでスナップショットを取得して板を再同期する"""
+        if self.api is None or self._pending is not None:
+            return False
+        if time() - self.health.last_resync < self.resync_interval:
+            return False
+        self.logger.warning(f'orderbook needs to be sync. {reason}')
+        self._pending = []
+        asyncio.ensure_future(self._resync())
+        return True
+
+    async def _resync(self):
+        try:
+            self.health.last_resync = time()
+            ob = await self.api.orderbooks(self.pair)
+            async with self.cond:
+                self._create(ob)
+                for board in self._pending:
+                    self._update(board)
+                self.health.resyncs += 1
+                self.health.replayed_diffs += len(self._pending)
+                self._updated = True
+                self.cond.notify()
+        except Exception as e:
+            self.health.resync_errors += 1
+            self.logger.warning(type(e).__name__ + ": {0}".format(e))
+        finally:
+            self._pending = None
+
+    async def _watch_stale(self):
+        while True:
+            await asyncio.sleep(1)
+            if time() - self.health.last_update > self.stale_seconds:
+                self.health.stale += 1
+                self.resync(f'stale {self.stale_seconds}s')
+
     def sort(self):
-        if self._needs_sort:
-            self._needs_sort = False
-            self.temp_bids = {k:v for k,v in self.temp_bids.items() if v>0}
-            self.temp_asks = {k:v for k,v in self.temp_asks.items() if v>0}
-            self.bids = [{'price':k,'size':v} for k,v in sorted(self.temp_bids.items(),reverse=True)]
-            self.asks = [{'price':k,'size':v} for k,v in sorted(self.temp_asks.items())]
+        # 板は常に整列済み
         return self.bids, self.asks
 
+    def bid_arrays(self):
+        return self._bids.arrays()
+
+    def ask_arrays(self):
+        return self._asks.arrays()
+
     async def wait(self):
         async with self.cond:
             await self.cond.wait_for(lambda:self._updated)
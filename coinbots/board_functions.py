@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import numpy as np
 from math import fsum
 
 def findPriceByDepth(board, depth):
@@ -56,6 +57,50 @@ def binningByPriceLadder(board, step, round_price=int):
         ret.append({'size':total,'price':round_price(fsum(i['price']*i['size'] for i in buc)/total)})
     return ret
 
+# NumPy配列版
+# prices/sizes は最良気配から並んだ配列、cumsizes は sizes の累積和
+
+def toArrays(board):
+    prices = np.fromiter((b['price'] for b in board), np.float64, len(board))
+    sizes = np.fromiter((b['size'] for b in board), np.float64, len(board))
+    return prices, sizes, np.cumsum(sizes)
+
+def findPriceByDepthArray(prices, cumsizes, depth):
+    i = np.searchsorted(cumsizes, depth)
+    return prices[min(i, len(prices)-1)]
+
+def depthForDistanceArray(prices, cumsizes, distance):
+    i = np.searchsorted(np.abs(prices-prices[0]), distance)
+    return cumsizes[min(i, len(cumsizes)-1)]
+
+def filterBySizeArray(prices, sizes, size):
+    mask = sizes >= size
+    return prices[mask], sizes[mask]
+
+def _binning(prices, sizes, starts, round_price):
+    total = np.add.reduceat(sizes, starts)
+    vwap = np.add.reduceat(prices*sizes, starts) / total
+    if round_price is int:
+        vwap = np.trunc(vwap)
+    elif round_price is not None:
+        vwap = np.fromiter(map(round_price, vwap), np.float64, len(vwap))
+    return vwap, total
+
+def binningBySizeArray(prices, sizes, cumsizes, size, round_price=int):
+    starts = []
+    i = 0
+    n = len(sizes)
+    while i < n:
+        starts.append(i)
+        base = cumsizes[i-1] if i else 0
+        i = int(np.searchsorted(cumsizes, base+size)) + 1
+    return _binning(prices, sizes, np.array(starts, dtype=np.intp), round_price)
+
+def binningByPriceLadderArray(prices, sizes, step, round_price=int):
+    ladder = prices//step
+    starts = np.concatenate(([0], np.flatnonzero(ladder[1:] != ladder[:-1])+1))
+    return _binning(prices, sizes, starts, round_price)
+
 if __name__ == "__main__":
     import argparse
     import logging
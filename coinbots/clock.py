@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from heapq import heappush, heappop
+
+class Clock:
+    """実時間の時計"""
+
+    def time(self):
+        return time.time()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    async def wait(self, event, timeout):
+        """event がセットされるか timeout 秒経つまで待つ (セットされたら True)"""
+        waiter = asyncio.ensure_future(event.wait())
+        timer = asyncio.ensure_future(self.sleep(timeout))
+        try:
+            await asyncio.wait([waiter, timer], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+            timer.cancel()
+        return event.is_set()
+
+class SimClock(Clock):
+    """シミュレーション用の時計
+
+    sleep() は実際には待たずに起床時刻を登録する。全タスクが待ち状態に
+    なったところで advance() を呼ぶと、最も早い起床時刻まで時間を進めて
+    そのタスクを起こす。
+    """
+
+    def __init__(self, start=0):
+        self.now = start
+        self.timers = []
+        self.seq = 0
+
+    def time(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        fut = asyncio.get_event_loop().create_future()
+        heappush(self.timers, (self.now + max(seconds, 0), self.seq, fut))
+        self.seq += 1
+        await fut
+
+    def next_time(self):
+        """次の起床時刻 (待っているタスクがなければ None)"""
+        while len(self.timers) and self.timers[0][2].done():
+            heappop(self.timers)
+        return self.timers[0][0] if len(self.timers) else None
+
+    def advance(self):
+        """次の起床時刻まで進め、その時刻に起きるタスクを全て起こす"""
+        when = self.next_time()
+        if when is None:
+            return None
+        self.now = max(self.now, when)
+        while len(self.timers) and self.timers[0][0] <= when:
+            _, _, fut = heappop(self.timers)
+            if not fut.done():
+                fut.set_result(None)
+        return when
+
+    async def settle(self, max_iterations=1000):
+        """実行可能なタスクがなくなるまで他のタスクに実行機会を与える"""
+        loop = asyncio.get_event_loop()
+        if not hasattr(loop, '_ready'):
+            # 実行待ちのキューを見られないイベントループ(uvloop等)では待ち状態を判定できない
+            raise RuntimeError('SimClock.settle requires an asyncio event loop with _ready ({0})'.format(type(loop).__name__))
+        for _ in range(max_iterations):
+            await asyncio.sleep(0)
+            # 実行待ちのコールバックが残っていなければ全タスクが待ち状態
+            if not loop._ready:
+                break
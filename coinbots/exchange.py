@@ -33,9 +33,9 @@ class Exchange:
         }),
     }
 
-    def __init__(self, apiKey, secret):
+    def __init__(self, apiKey, secret, rate_limits=None):
         self.private_api_enabled = len(apiKey) and len(secret)
-        self.api = CCAPI(apiKey, secret)
+        self.api = CCAPI(apiKey, secret, rate_limits)
         self.logger = logging.getLogger(__name__)
 
     def _get_data(self, res, default, errfrom, subfield=None):
@@ -93,6 +93,10 @@ class Exchange:
         orderRes['status'] = 'cancel'
         return orderRes
 
+    async def cancel_status(self, order_id):
+        res = await self.api.cancel_status(order_id)
+        return self._get_data(res, {}, f'cancel_status with {order_id}')
+
     async def get_orders(self, pair=None):
         res = await self.api.orders_opens()
         return self._get_data(res, [], 'orders_opens', 'orders')
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+from math import sqrt, nan, isnan
+
+class Indicator:
+    """逐次計算インジケーター
+
+    source にはOHLCVのカラム名か、別のインジケーターを指定する。
+    update() に新しい足の値を渡すと、その時点の値を返す。
+    """
+
+    fields = None
+
+    def __init__(self, source='close'):
+        self.source = source
+        self.value = nan
+
+    def on_bar(self, bar):
+        if isinstance(self.source, Indicator):
+            x = self.source.on_bar(bar)
+        else:
+            x = bar[self.source]
+        return self.update(x)
+
+    def update(self, x):
+        raise NotImplementedError
+
+class _RollingSum:
+    """窓内の合計(補正付き) 欠損値は数えない"""
+
+    def __init__(self, period):
+        self.period = int(period)
+        self.q = deque()
+        self.count = 0
+        self.sum = 0.0
+        self.c = 0.0
+
+    def _add(self, x):
+        t = self.sum + x
+        if abs(self.sum) >= abs(x):
+            self.c += (self.sum - t) + x
+        else:
+            self.c += (x - t) + self.sum
+        self.sum = t
+
+    def push(self, x):
+        self.q.append(x)
+        if not isnan(x):
+            self._add(x)
+            self.count += 1
+        if len(self.q) > self.period:
+            y = self.q.popleft()
+            if not isnan(y):
+                self._add(-y)
+                self.count -= 1
+        if self.count == 0:
+            # 誤差が残らないようにリセット
+            self.sum = 0.0
+            self.c = 0.0
+        return self.sum + self.c
+
+class _RollingVar:
+    """窓内の平均・分散(Welford法) 欠損値は数えない"""
+
+    def __init__(self, period):
+        self.period = int(period)
+        self.q = deque()
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def push(self, x):
+        self.q.append(x)
+        if not isnan(x):
+            self.count += 1
+            d = x - self.mean
+            self.mean += d / self.count
+            self.m2 += d * (x - self.mean)
+        if len(self.q) > self.period:
+            y = self.q.popleft()
+            if not isnan(y):
+                self.count -= 1
+                if self.count == 0:
+                    self.mean = 0.0
+                    self.m2 = 0.0
+                else:
+                    d = y - self.mean
+                    self.mean -= d / self.count
+                    self.m2 -= d * (y - self.mean)
+        if self.m2 < 0:
+            self.m2 = 0.0
+
+    def var(self, ddof=1):
+        if self.count - ddof <= 0:
+            return nan
+        return self.m2 / (self.count - ddof)
+
+class _Ewm:
+    """pandas ewm(adjust=True) 相当"""
+
+    def __init__(self, alpha):
+        self.decay = 1.0 - alpha
+        self.num = 0.0
+        self.den = 0.0
+
+    def push(self, x):
+        if not isnan(x):
+            self.num = self.num * self.decay + x
+            self.den = self.den * self.decay + 1.0
+        elif self.den:
+            # 欠損値も重みの減衰には含める(ignore_na=False)
+            self.num *= self.decay
+            self.den *= self.decay
+        return self.num / self.den if self.den else nan
+
+class _RollingExtreme:
+    """単調デックによる窓内の最大値/最小値 欠損値は無視する"""
+
+    def __init__(self, period, highest):
+        self.period = int(period)
+        self.highest = highest
+        self.q = deque()
+        self.i = 0
+
+    def push(self, x):
+        q = self.q
+        if not isnan(x):
+            if self.highest:
+                while q and q[-1][1] <= x:
+                    q.pop()
+            else:
+                while q and q[-1][1] >= x:
+                    q.pop()
+            q.append((self.i, x))
+        if q and q[0][0] <= self.i - self.period:
+            q.popleft()
+        self.i += 1
+        return q[0][1] if q else nan
+
+class SMA(Indicator):
+
+    def __init__(self, source='close', period=10):
+        super().__init__(source)
+        self.s = _RollingSum(period)
+
+    def update(self, x):
+        total = self.s.push(x)
+        self.value = total / self.s.count if self.s.count else nan
+        return self.value
+
+class EMA(Indicator):
+
+    def __init__(self, source='close', period=10):
+        super().__init__(source)
+        self.e = _Ewm(2.0 / (period + 1))
+
+    def update(self, x):
+        self.value = self.e.push(x)
+        return self.value
+
+class RMA(Indicator):
+
+    def __init__(self, source='close', period=10):
+        super().__init__(source)
+        self.e = _Ewm(1.0 / period)
+
+    def update(self, x):
+        self.value = self.e.push(x)
+        return self.value
+
+class Variance(Indicator):
+
+    def __init__(self, source='close', period=10):
+        super().__init__(source)
+        self.v = _RollingVar(period)
+
+    def update(self, x):
+        self.v.push(x)
+        self.value = self.v.var()
+        return self.value
+
+class Stdev(Variance):
+
+    def update(self, x):
+        self.v.push(x)
+        var = self.v.var()
+        self.value = sqrt(var) if not isnan(var) else nan
+        return self.value
+
+class Highest(Indicator):
+
+    def __init__(self, source='high', period=10):
+        super().__init__(source)
+        self.q = _RollingExtreme(period, True)
+
+    def update(self, x):
+        self.value = self.q.push(x)
+        return self.value
+
+class Lowest(Indicator):
+
+    def __init__(self, source='low', period=10):
+        super().__init__(source)
+        self.q = _RollingExtreme(period, False)
+
+    def update(self, x):
+        self.value = self.q.push(x)
+        return self.value
+
+class Change(Indicator):
+
+    def __init__(self, source='close', period=1):
+        super().__init__(source)
+        self.q = deque(maxlen=int(period)+1)
+
+    def update(self, x):
+        self.q.append(x)
+        if len(self.q) == self.q.maxlen:
+            self.value = x - self.q[0]
+        else:
+            self.value = 0.0
+        return self.value
+
+class Momentum(Change):
+
+    def update(self, x):
+        super().update(x)
+        if len(self.q) < self.q.maxlen:
+            self.value = nan
+        return self.value
+
+class RSI(Indicator):
+
+    def __init__(self, source='close', period=14):
+        super().__init__(source)
+        self.last = nan
+        self.positive = _Ewm(1.0 / period)
+        self.negative = _Ewm(1.0 / period)
+
+    def update(self, x):
+        diff = x - self.last
+        self.last = x
+        positive = self.positive.push(max(diff, 0) if not isnan(diff) else nan)
+        negative = self.negative.push(min(diff, 0) if not isnan(diff) else nan)
+        if negative == 0:
+            self.value = 100.0 if positive else nan
+        elif isnan(negative):
+            self.value = nan
+        else:
+            self.value = 100 - 100 / (1 - positive / negative)
+        return self.value
+
+class TR(Indicator):
+    """source は無視し、close/high/low を使う"""
+
+    def __init__(self):
+        super().__init__(None)
+        self.last = nan
+
+    def on_bar(self, bar):
+        return self.update(bar['close'], bar['high'], bar['low'])
+
+    def update(self, close, high, low):
+        tr = high - low
+        if not isnan(self.last):
+            tr = max(tr, abs(high - self.last), abs(low - self.last))
+        self.last = close
+        self.value = tr
+        return self.value
+
+class ATR(TR):
+
+    def __init__(self, period=14):
+        super().__init__()
+        self.e = _Ewm(1.0 / period)
+
+    def update(self, close, high, low):
+        self.value = self.e.push(super().update(close, high, low))
+        return self.value
+
+class BBand(Indicator):
+
+    fields = ('upper', 'lower', 'middle', 'sigma')
+
+    def __init__(self, source='close', period=20, mult=2.0):
+        super().__init__(source)
+        self.period = int(period)
+        self.mult = mult
+        self.v = _RollingVar(period)
+
+    def update(self, x):
+        self.v.push(x)
+        if self.v.count < self.period:
+            self.value = (nan, nan, nan, nan)
+        else:
+            middle = self.v.mean
+            sigma = sqrt(self.v.var())
+            self.value = (middle+sigma*self.mult, middle-sigma*self.mult, middle, sigma)
+        return self.value
+
+class MACD(Indicator):
+
+    fields = ('macd', 'signal', 'hist')
+
+    def __init__(self, source='close', fastlen=12, slowlen=26, siglen=9):
+        super().__init__(source)
+        self.fast = _Ewm(2.0 / (fastlen + 1))
+        self.slow = _Ewm(2.0 / (slowlen + 1))
+        self.siglen = int(siglen)
+        self.signal = _RollingSum(siglen)
+
+    def update(self, x):
+        macd = self.fast.push(x) - self.slow.push(x)
+        total = self.signal.push(macd)
+        if self.signal.count < self.siglen:
+            signal = nan
+        else:
+            signal = total / self.siglen
+        self.value = (macd, signal, macd-signal)
+        return self.value
+
+if __name__ == '__main__':
+    import numpy as np
+    import pandas as pd
+    from . import indicator as ind
+
+    # 逐次計算と一括計算(indicator.py)の比較 欠損値を含む連結ソースも確認する
+    rng = np.random.default_rng(0)
+    close = pd.Series(5000000 + np.cumsum(rng.normal(0, 300, 200)))
+    bars = [{'close':c} for c in close]
+    mom = ind.momentum(close, 10)
+
+    def run(indicator):
+        values = [indicator.on_bar(bar) for bar in bars]
+        if indicator.fields:
+            return [pd.Series([v[i] for v in values]) for i in range(len(indicator.fields))]
+        return pd.Series(values)
+
+    cases = [
+        ('sma', SMA('close', 20), ind.sma(close, 20)),
+        ('stdev', Stdev('close', 20), ind.stdev(close, 20)),
+        ('ema', EMA('close', 20), ind.ema(close, 20)),
+        ('momentum', Momentum('close', 10), mom),
+        ('sma(momentum)', SMA(Momentum('close', 10), 20), ind.sma(mom, 20)),
+        ('stdev(momentum)', Stdev(Momentum('close', 10), 20), ind.stdev(mom, 20)),
+        ('variance(momentum)', Variance(Momentum('close', 10), 20), ind.variance(mom, 20)),
+        ('ema(momentum)', EMA(Momentum('close', 10), 20), ind.ema(mom, 20)),
+        ('highest(momentum)', Highest(Momentum('close', 10), 20), ind.highest(mom, 20)),
+        ('lowest(momentum)', Lowest(Momentum('close', 10), 20), ind.lowest(mom, 20)),
+    ]
+    for name, indicator, expected in cases:
+        result = run(indicator)
+        assert np.allclose(result.values, expected.values, rtol=1e-9, equal_nan=True), name
+        print(f'{name} ok ({int(expected.isna().sum())} nan)')
+
+    for name, indicator, expected in [
+        ('bband(momentum)', BBand(Momentum('close', 10), 20), ind.bband(mom, 20)),
+        ('macd', MACD('close', 12, 26, 9), ind.macd(close, 12, 26, 9))]:
+        for result, e in zip(run(indicator), expected):
+            assert np.allclose(result.values, e.values, rtol=1e-9, equal_nan=True), name
+        print(f'{name} ok')
@@ -2,6 +2,7 @@
 import pandas as pd
 import numpy as np
 from functools import lru_cache
+from math import comb
 from numba import jit, b1, f8, i8, void
 
 @jit(void(f8[:],i8,i8,f8[:]),nopython=True)
@@ -355,13 +356,100 @@ def __rci_core__(v, n, p, r):
         r[i] = ((1.0 - (6.0 * __rci_d__(v, i, p)) / k)) * 100.0
 
 def fastrci(source, period):
-    v = source.values
+    v = source.values.astype(np.float64)
     n = len(v)
     p = int(period)
     r = np.empty(n)
     __rci_core__(v,n,p,r)
     return pd.Series(r, index=source.index)
 
+@jit(i8(i8[:],i8),nopython=True)
+def __bit_sum__(tree, i):
+    # 1..i の合計
+    total = 0
+    while i > 0:
+        total += tree[i]
+        i -= i & -i
+    return total
+
+@jit(void(i8[:],i8,i8),nopython=True)
+def __bit_add__(tree, i, x):
+    n = len(tree)
+    while i < n:
+        tree[i] += x
+        i += i & -i
+
+@jit(void(i8[:],i8,i8,i8,f8[:]),nopython=True)
+def __rollingrci_core__(rank, n, p, m, r):
+    """
+    fastrci と同じ順位付け(自分より大きい値の数+1、同値は同順位)で
+    d = Σt² + Σo² - 2Σt·o を窓の追加・削除ごとに更新する。
+    t: 新しい順の時間順位 (i+1-s)、o = 1+G (G: 窓内で自分より大きい値の数)
+    値の順位ごとに 個数・時刻s の和・同値ペア数 をFenwick木で持つ。
+    """
+    cnt = np.zeros(m+1, dtype=np.int64)
+    ssum = np.zeros(m+1, dtype=np.int64)
+    tie = np.zeros(m+1, dtype=np.int64)
+    same = np.zeros(m+1, dtype=np.int64)
+    size = 0
+    sg2 = 0   # ΣG²
+    ssg = 0   # Σs·G
+    ss = 0    # Σs
+    ties = 0  # 同値ペア数
+    k = p * (p * p - 1)
+    st2 = p * (p + 1) * (2 * p + 1) // 6
+    for i in range(n):
+        # 追加
+        x = rank[i] + 1
+        a = __bit_sum__(cnt, x-1)
+        e = same[x]
+        b = size - a - e
+        below = a * (b + e) + a * (a - 1) // 2 - __bit_sum__(tie, x-1)
+        sg2 += 2 * below + a + b * b
+        ssg += __bit_sum__(ssum, x-1) + i * b
+        ss += i
+        ties += e
+        __bit_add__(cnt, x, 1)
+        __bit_add__(ssum, x, i)
+        __bit_add__(tie, x, e)
+        same[x] = e + 1
+        size += 1
+        # 削除
+        if size > p:
+            j = i - p
+            y = rank[j] + 1
+            a = __bit_sum__(cnt, y-1)
+            e = same[y]
+            b = size - a - e
+            below = a * (b + e) + a * (a - 1) // 2 - __bit_sum__(tie, y-1)
+            sg2 += -2 * below + a - b * b
+            ssg -= __bit_sum__(ssum, y-1) + j * b
+            ss -= j
+            ties -= e - 1
+            __bit_add__(cnt, y, -1)
+            __bit_add__(ssum, y, -j)
+            __bit_add__(tie, y, -(e - 1))
+            same[y] = e - 1
+            size -= 1
+        if size < p:
+            r[i] = np.nan
+            continue
+        sg = p * (p - 1) // 2 - ties
+        so2 = p + 2 * sg + sg2
+        sto = (i + 1) * (p + sg) - ss - ssg
+        d = st2 + so2 - 2 * sto
+        r[i] = (1.0 - (6.0 * d) / k) * 100.0
+
+def rollingrci(source, period):
+    """fastrci と同じ値を O(n log n) で計算する (欠損値は扱わない)"""
+    p = int(period)
+    values, rank = np.unique(source.values, return_inverse=True)
+    rank = rank.astype(np.int64).ravel()
+    n = len(rank)
+    r = np.empty(n)
+    __rollingrci_core__(rank, n, p, len(values), r)
+    return pd.Series(r, index=source.index)
+
 def rci(source, period):
     """
     ord(seq, idx, itv) =>
@@ -418,6 +506,77 @@ def polyfline(source, period, deg=2):
         poly[i] = p(period-1)
     return pd.Series(poly, index=source.index)
 
+@jit(void(f8[:],i8,i8,f8[:],f8[:,:],i8,f8[:]),nopython=True)
+def __rollingpolyfit_core__(v, n, p, w, shift, resync, r):
+    """
+    x を窓の中心からの位置 (-h..h) としたモーメント M_k = Σ x^k (y-c) を
+    1本ずつずらしながら更新する。ずらす時は二項展開で x -> x-1 に変換し、
+    誤差が溜まらないように resync 本ごとに窓から計算し直す。
+    """
+    deg1 = len(w)
+    h = (p - 1) / 2.0
+    hp = np.empty(deg1)
+    hm = np.empty(deg1)
+    for k in range(deg1):
+        hp[k] = h ** k
+        hm[k] = (-h) ** k
+    M = np.zeros(deg1)
+    M2 = np.zeros(deg1)
+    c = 0.0
+    for i in range(min(p, n)):
+        r[i] = np.nan
+    for i in range(p, n):
+        if (i - p) % resync == 0:
+            c = v[i-p]
+            for k in range(deg1):
+                M[k] = 0.0
+            for t in range(p):
+                x = t - h
+                y = v[i-p+t] - c
+                xk = 1.0
+                for k in range(deg1):
+                    M[k] += xk * y
+                    xk *= x
+        else:
+            # 一番古い値(x=-h)を削除
+            y = v[i-p-1] - c
+            for k in range(deg1):
+                M[k] -= hm[k] * y
+            # x -> x-1
+            for k in range(deg1):
+                total = 0.0
+                for j in range(k+1):
+                    total += shift[k,j] * M[j]
+                M2[k] = total
+            # 新しい値(x=h)を追加
+            y = v[i-1] - c
+            for k in range(deg1):
+                M[k] = M2[k] + hp[k] * y
+        fit = c
+        for k in range(deg1):
+            fit += w[k] * M[k]
+        r[i] = fit
+
+def rollingpolyfline(source, period, deg=2, resync=None):
+    """polyfline と同じ値を窓のモーメントの更新で計算する (欠損値は扱わない)"""
+    period = int(period)
+    deg = int(deg)
+    v = source.values.astype(np.float64)
+    n = len(v)
+    # 窓の最後(x=h)での当てはめ値 = w・M, w = (XᵀX)⁻¹[1, h, h², ...]
+    h = (period - 1) / 2.0
+    x = np.arange(period) - h
+    X = np.vander(x, deg+1, increasing=True)
+    w = np.linalg.solve(X.T @ X, h ** np.arange(deg+1))
+    # (x-1)^k = Σ C(k,j)(-1)^(k-j) x^j
+    shift = np.zeros((deg+1, deg+1))
+    for k in range(deg+1):
+        for j in range(k+1):
+            shift[k,j] = comb(k, j) * (-1) ** (k - j)
+    r = np.empty(n)
+    __rollingpolyfit_core__(v, n, period, w, shift, int(resync or period), r)
+    return pd.Series(r, index=source.index)
+
 def correlation(source_a, source_b, period):
     period = int(period)
     return source_a.rolling(period).corr(source_b)
@@ -425,6 +584,162 @@ def correlation(source_a, source_b, period):
 def cumsum(source, period):
     return source.rolling(int(period),min_periods=1).sum()
 
+# 複数期間の一括計算 (時間 x 期間 の2次元で返す)
+
+def _periods(periods):
+    return np.asarray(periods, dtype=np.int64).ravel()
+
+def _frame(r, source, periods):
+    # カーネルは期間ごとに連続した (期間 x 時間) で書き込むので転置して返す
+    return pd.DataFrame(r.T, index=source.index, columns=periods, copy=False)
+
+@jit(void(f8[:],i8[:],f8[:,:]),nopython=True)
+def __multisma_core__(v, periods, r):
+    n = len(v)
+    # 先頭の値を引いた累積和 (桁落ちを抑える)
+    cs = np.empty(n+1)
+    cs[0] = 0.0
+    for i in range(n):
+        cs[i+1] = cs[i] + (v[i] - v[0])
+    for j in range(len(periods)):
+        p = periods[j]
+        for i in range(n):
+            lo = max(i + 1 - p, 0)
+            r[j,i] = (cs[i+1] - cs[lo]) / (i + 1 - lo) + v[0]
+
+def multisma(source, periods):
+    """sma の複数期間版 (欠損値は扱わない)"""
+    v = source.values.astype(np.float64)
+    periods = _periods(periods)
+    r = np.empty((len(periods), len(v)))
+    if len(v):
+        __multisma_core__(v, periods, r)
+    return _frame(r, source, periods)
+
+@jit(void(f8[:],f8[:],f8[:,:]),nopython=True)
+def __multiewm_core__(v, alphas, r):
+    n = len(v)
+    for j in range(len(alphas)):
+        decay = 1.0 - alphas[j]
+        num = 0.0
+        den = 0.0
+        for i in range(n):
+            x = v[i]
+            if not np.isnan(x):
+                num = num * decay + x
+                den = den * decay + 1.0
+            else:
+                num = num * decay
+                den = den * decay
+            r[j,i] = num / den if den > 0 else np.nan
+
+def _multiewm(v, alphas):
+    r = np.empty((len(alphas), len(v)))
+    __multiewm_core__(v, alphas, r)
+    return r
+
+def multiema(source, periods):
+    """ema の複数期間版"""
+    periods = _periods(periods)
+    return _frame(_multiewm(source.values.astype(np.float64), 2.0 / (periods + 1.0)), source, periods)
+
+@jit(void(f8[:],i8[:],i8,f8[:,:]),nopython=True)
+def __multistdev_core__(v, periods, resync, r):
+    """
+    窓への追加と削除を1回の更新で行う。誤差が溜まらないように
+    resync 本ごと (0なら期間ごと) に窓から平均と偏差平方和を計算し直す。
+    """
+    n = len(v)
+    for j in range(len(periods)):
+        p = periods[j]
+        rs = resync if resync > 0 else p
+        # 基準値からの差で計算する (分散は平行移動で不変)
+        c = v[0]
+        mean = 0.0
+        m2 = 0.0
+        for i in range(min(p, n)):
+            # 窓が埋まるまではWelford法で追加
+            x = v[i] - c
+            d = x - mean
+            mean += d / (i + 1)
+            m2 += d * (x - mean)
+            r[j,i] = np.sqrt(max(m2, 0.0) / i) if i > 0 else np.nan
+        inv_p = 1.0 / p
+        inv_p1 = 1.0 / (p - 1) if p > 1 else np.nan
+        for i in range(p, n):
+            if (i - p) % rs == rs - 1:
+                # 窓から計算し直す (基準値も窓の先頭に移す)
+                c = v[i-p+1]
+                mean = 0.0
+                for t in range(i-p+1, i+1):
+                    mean += v[t] - c
+                mean *= inv_p
+                m2 = 0.0
+                for t in range(i-p+1, i+1):
+                    d = v[t] - c - mean
+                    m2 += d * d
+            else:
+                # 追加と削除を1回で更新
+                x = v[i] - c
+                y = v[i-p] - c
+                d = x - y
+                prev = mean
+                mean += d * inv_p
+                m2 += d * (x - mean + y - prev)
+                if m2 < 0:
+                    m2 = 0.0
+            r[j,i] = np.sqrt(m2 * inv_p1)
+
+def multistdev(source, periods, resync=None):
+    """stdev の複数期間版 (欠損値は扱わない)"""
+    v = source.values.astype(np.float64)
+    periods = _periods(periods)
+    r = np.empty((len(periods), len(v)))
+    __multistdev_core__(v, periods, int(resync or 0), r)
+    return _frame(r, source, periods)
+
+@jit(void(f8[:,:],f8[:,:],f8[:,:]),nopython=True)
+def __multirsi_core__(positive, negative, r):
+    m, n = positive.shape
+    for j in range(m):
+        for i in range(n):
+            pos = positive[j,i]
+            neg = negative[j,i]
+            if neg == 0:
+                r[j,i] = 100.0 if pos > 0 else np.nan
+            else:
+                r[j,i] = 100.0 - 100.0 / (1.0 - pos / neg)
+
+def multirsi(source, periods):
+    """rsi の複数期間版"""
+    periods = _periods(periods)
+    v = source.values.astype(np.float64)
+    diff = np.empty(len(v))
+    diff[:1] = np.nan
+    diff[1:] = v[1:] - v[:-1]
+    alphas = 1.0 / periods
+    # 差分の正負は全期間で共通
+    positive = _multiewm(np.where(diff > 0, diff, np.where(np.isnan(diff), np.nan, 0.0)), alphas)
+    negative = _multiewm(np.where(diff < 0, diff, np.where(np.isnan(diff), np.nan, 0.0)), alphas)
+    r = np.empty(positive.shape)
+    __multirsi_core__(positive, negative, r)
+    return _frame(r, source, periods)
+
+def multiatr(close, high, low, periods):
+    """atr の複数期間版"""
+    periods = _periods(periods)
+    c = close.values.astype(np.float64)
+    h = high.values.astype(np.float64)
+    l = low.values.astype(np.float64)
+    # TRは全期間で共通
+    last = np.empty(len(c))
+    last[:1] = np.nan
+    last[1:] = c[:-1]
+    tr = h - l
+    tr = np.fmax(tr, np.abs(h - last))
+    tr = np.fmax(tr, np.abs(l - last))
+    return _frame(_multiewm(tr, 1.0 / periods), close, periods)
+
 def hlc3(ohlcv):
     return (ohlcv.high+ohlcv.low+ohlcv.close)/3
 
@@ -435,6 +750,62 @@ if __name__ == '__main__':
 
     from .utils import stop_watch
 
+    # 合成データで一括計算と既存実装を比較する (CSVがなくても動く)
+    rng = np.random.default_rng(0)
+    n = 20000
+    close = pd.Series(5000000 + np.cumsum(rng.normal(0, 300, n)))
+    high = close + rng.exponential(200, n)
+    low = close - rng.exponential(200, n)
+
+    # 複数期間の一括計算と単一期間版の比較
+    periods = list(range(5, 105, 5))
+
+    @stop_watch
+    def loop_sma(source, periods):
+        return pd.DataFrame({p:sma(source, p) for p in periods})
+
+    @stop_watch
+    def loop_stdev(source, periods):
+        return pd.DataFrame({p:stdev(source, p) for p in periods})
+
+    # rsi/atr と同じ式 (clip_lower や fillna(method=) は新しい pandas では使えないため書き直したもの)
+    def ref_rsi(source, period):
+        diff = source.diff()
+        positive = diff.clip(lower=0).ewm(alpha=1.0/period).mean()
+        negative = diff.clip(upper=0).ewm(alpha=1.0/period).mean()
+        return 100-100/(1-positive/negative)
+
+    def ref_atr(close, high, low, period):
+        last = close.shift(1).ffill()
+        tr = pd.concat([high - low, (high - last).abs(), (low - last).abs()], axis=1).max(axis=1)
+        return tr.ewm(alpha=1.0/period).mean()
+
+    assert np.allclose(stop_watch(multisma)(close, periods).values, loop_sma(close, periods).values, equal_nan=True)
+    assert np.allclose(stop_watch(multistdev)(close, periods).values, loop_stdev(close, periods).values, equal_nan=True)
+    multi = stop_watch(multiema)(close, periods)
+    assert all(np.allclose(multi[p].values, ema(close, p).values) for p in periods)
+    multi = stop_watch(multirsi)(close, periods)
+    assert all(np.allclose(multi[p].values, ref_rsi(close, p).values, equal_nan=True) for p in periods)
+    multi = stop_watch(multiatr)(close, high, low, periods)
+    assert all(np.allclose(multi[p].values, ref_atr(close, high, low, p).values, equal_nan=True) for p in periods)
+    print('multi ok')
+
+    # 窓の更新によるRCI・多項式回帰と既存実装の比較 (同値を多く含む系列も確認する)
+    sources = {
+        'walk':close,
+        'rounded':(close / 1000).round(),
+        'ties':pd.Series(rng.integers(0, 5, n).astype(np.float64)),
+    }
+    for name, source in sources.items():
+        for period in [14, 50]:
+            assert np.allclose(stop_watch(rollingrci)(source, period).values,
+                stop_watch(fastrci)(source, period).values, equal_nan=True), (name, period)
+            head = source[:2000]
+            for deg in [1, 2, 3]:
+                assert np.allclose(rollingpolyfline(head, period, deg).values,
+                    polyfline(head, period, deg).values, equal_nan=True), (name, period, deg)
+        print(f'rollingrci/rollingpolyfline {name} ok')
+
     # p0 = 8000 #初期値
     # vola = 15.0 #ボラティリティ(%)
     # dn = np.random.randint(2, size=1000)*2-1
@@ -469,7 +840,7 @@ if __name__ == '__main__':
     rci = stop_watch(rci)
     fastrci = stop_watch(fastrci)
     polyfline = stop_watch(polyfline)
-    corr = stop_watch(corr)
+    corr = stop_watch(correlation)
 
     vfastsma = fastsma(ohlc.close, 10)
     vsma = sma(ohlc.close, 10)
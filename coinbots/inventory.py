@@ -6,7 +6,8 @@ from itertools import chain
 from operator import itemgetter
 from math import fsum
 from datetime import datetime, timedelta
-import time
+from .utils import compensated_sum
+from .clock import Clock
 
 class Inventory:
 
@@ -14,20 +15,42 @@ class Inventory:
 
         def __init__(self, spec, initial_positions=[]):
             self.spec = spec
-            self.positions = deque(initial_positions)
+            self.positions = deque()
+            self._reset_sums()
+            for p in initial_positions:
+                self._push(p.copy())
             self.compute_summary()
             self.netprofit = 0
 
+        def _reset_sums(self):
+            # 建玉の売買別サイズと総額
+            self._sizes = {'buy':compensated_sum(), 'sell':compensated_sum()}
+            self._notional = compensated_sum()
+
+        def _push(self, p, left=False):
+            if left:
+                self.positions.appendleft(p)
+            else:
+                self.positions.append(p)
+            self._sizes[p['side']].add(p['amount'])
+            self._notional.add(p['rate']*p['amount'])
+
+        def _pop(self, left=False):
+            p = self.positions.popleft() if left else self.positions.pop()
+            self._sizes[p['side']].add(-p['amount'])
+            self._notional.add(-p['rate']*p['amount'])
+            return p
+
         def add(self, p):
             """建玉追加"""
-            self.positions.append(p.copy())
+            self._push(p.copy())
             while len(self.positions)>=2:
-                r = self.positions.pop()
-                l = self.positions.popleft()
+                r = self._pop()
+                l = self._pop(left=True)
                 if r['side']==l['side']:
                     # 売買方向が同じなら取り出したポジションを戻す
-                    self.positions.append(r)
-                    self.positions.appendleft(l)
+                    self._push(r)
+                    self._push(l, left=True)
                     break
                 else:
                     if l['amount'] >= r['amount']:
@@ -36,14 +59,14 @@ class Inventory:
                         l['amount'] = self.spec.round_amount(fsum([l['amount'],-r['amount']]))
                         if l['amount'] > 0:
                             # サイズが残っている場合、ポジションを戻す
-                            self.positions.appendleft(l)
+                            self._push(l, left=True)
                     else:
                         pnl = (r['rate']-l['rate'])*l['amount']
                         # 決済
                         r['amount'] = self.spec.round_amount(fsum([r['amount'],-l['amount']]))
                         if r['amount'] > 0:
                             # サイズが残っている場合、ポジションを戻す
-                            self.positions.append(r)
+                            self._push(r)
                     if l['side']=='sell':
                         pnl *= -1
                     self.netprofit += pnl
@@ -52,56 +75,204 @@ class Inventory:
 
         def compute_summary(self):
             """サマリー計算"""
-            positions = list(self.positions)
-            if len(positions):
-                ltp = positions[-1]['rate']
-                self.long_size = self.spec.round_amount(fsum(p['amount'] for p in positions if p['side']=='buy'))
-                self.short_size = self.spec.round_amount(fsum(p['amount'] for p in positions if p['side']=='sell'))
+            if len(self.positions):
+                ltp = self.positions[-1]['rate']
+                self.long_size = self.spec.round_amount(self._sizes['buy'].value)
+                self.short_size = self.spec.round_amount(self._sizes['sell'].value)
                 self.position_size = self.long_size - self.short_size
-                self.position_avg_price = self.spec.round_price(fsum(p['rate']*p['amount'] for p in positions)/(self.long_size+self.short_size))
+                self.position_avg_price = self.spec.round_price(self._notional.value/(self.long_size+self.short_size))
                 self.position_pnl = (ltp - self.position_avg_price) * self.position_size
             else:
+                # 誤差が残らないように集計をリセット
+                self._reset_sums()
                 self.long_size = 0
                 self.short_size = 0
                 self.position_avg_price = 0
                 self.position_size = 0
                 self.position_pnl = 0
 
+    class Balance:
+        """自分の約定(手数料込みのfunds)から逐次更新する残高"""
+
+        def __init__(self):
+            self.logger = logging.getLogger(__name__)
+            self.funds = defaultdict(compensated_sum)
+            self.synced = False
+            self.applied = 0
+            # 突き合わせで見つかったずれの最大値 (絶対値)
+            self.max_drift = defaultdict(float)
+
+        def apply(self, tr):
+            for currency, value in tr.get('funds', {}).items():
+                self.funds[currency].add(float(value))
+            self.applied += 1
+
+        def sync(self, balance, currencies):
+            """REST APIの残高で置き換え、ずれ(REST - ローカル)を返す"""
+            drift = {}
+            for c in currencies:
+                total = float(balance.get(c) or 0) + float(balance.get(c+'_reserved') or 0)
+                if self.synced:
+                    drift[c] = total - self.funds[c].value
+                    self.max_drift[c] = max(self.max_drift[c], abs(drift[c]))
+                self.funds[c] = compensated_sum(total)
+            self.synced = True
+            return drift
+
+        def get(self, base, quote, price=None, reserved=None):
+            """REST APIと同じ形式(利用可能額と注文中の拘束額)の残高"""
+            reserved = reserved or {}
+            result = {}
+            for c in (base, quote):
+                result[c] = self.funds[c].value - reserved.get(c, 0)
+                result[c+'_reserved'] = reserved.get(c, 0)
+            if price:
+                result[quote+'_total'] = self.funds[quote].value + self.funds[base].value * price
+            return result
+
+    class Order(dict):
+        """statusの変更を注文ストアに通知する注文"""
+
+        def __init__(self, store, orderRes):
+            super().__init__(orderRes)
+            self.store = store
+
+        def __setitem__(self, key, value):
+            if key == 'status':
+                old = self.get('status')
+                dict.__setitem__(self, key, value)
+                if old != value:
+                    self.store.move(self, old, value)
+            else:
+                dict.__setitem__(self, key, value)
+
+    class OrderStore:
+        """取引所IDとstatusで索引した注文ストア
+
+        終了した注文(約定・取消)は retention 秒、最大 maxlen 件まで保持する。
+        """
+
+        def __init__(self, clock, retention=600, maxlen=1000):
+            self.clock = clock
+            self.retention = retention
+            self.maxlen = maxlen
+            self.by_id = {}
+            self.by_status = defaultdict(dict)
+            self.updated = {}
+            # 約定数量と約定総額の累計 (注文の辞書には入れない)
+            self.fills = {}
+            self.terminated = deque()
+
+        def add(self, o):
+            self.by_id[o['id']] = o
+            self.by_status[o['status']][o['id']] = o
+            self.updated[o['id']] = self.clock.time()
+            self.fills[o['id']] = (compensated_sum(), compensated_sum())
+
+        def move(self, o, old, new):
+            if o['id'] not in self.by_id:
+                return
+            self.by_status[old].pop(o['id'], None)
+            self.by_status[new][o['id']] = o
+            now = self.clock.time()
+            self.updated[o['id']] = now
+            if new in Inventory.TERMINAL_STATUS:
+                self.terminated.append((now, o['id']))
+                self.prune(now)
+
+        def get(self, order_id):
+            return self.by_id.get(order_id)
+
+        def with_status(self, *statuses):
+            return [o for status in statuses for o in self.by_status[status].values()]
+
+        def count(self, *statuses):
+            return sum(len(self.by_status[status]) for status in statuses)
+
+        def _remove(self, order_id):
+            o = self.by_id.pop(order_id, None)
+            if o is not None:
+                self.by_status[o['status']].pop(order_id, None)
+                del self.updated[order_id]
+                del self.fills[order_id]
+
+        def prune(self, now=None):
+            now = now or self.clock.time()
+            while len(self.terminated):
+                t, order_id = self.terminated[0]
+                if now - t < self.retention and len(self.terminated) <= self.maxlen:
+                    break
+                self.terminated.popleft()
+                o = self.by_id.get(order_id)
+                if o is not None and o['status'] in Inventory.TERMINAL_STATUS:
+                    self._remove(order_id)
+            # 取消中のまま残った注文も保持期間を過ぎたら削除
+            for o in self.with_status('cancelling'):
+                if now - self.updated[o['id']] >= self.retention:
+                    self._remove(o['id'])
+
     OPEN_STATUS = ['open']
+    PENDING_STATUS = ['open', 'cancelling']
+    TERMINAL_STATUS = ['filled', 'cancel']
 
-    def __init__(self, spec):
+    # 注文ごとに保持する約定IDの数
+    TRADE_IDS_MAXLEN = 1000
+
+    def __init__(self, spec, clock=None):
         self.logger = logging.getLogger(__name__)
         self.spec = spec
-        self.active_orders = {}
-        self.nonactive_orders = {}
+        self.clock = clock or Clock()
+        self.orders = Inventory.OrderStore(self.clock)
         self.position = Inventory.Position(self.spec)
+        self.balance = Inventory.Balance()
         self.order_for_myid = defaultdict(lambda:{\
             'status': 'cancel',
             })
 
     def new_order(self, myid, orderRes):
-        orderRes['myid'] = myid
-        orderRes['trades'] = {}
-        self.active_orders[orderRes['id']] = orderRes
-        self.order_for_myid[myid] = orderRes
+        o = Inventory.Order(self.orders, orderRes)
+        o['myid'] = myid
+        o['trades'] = {}
+        self.orders.add(o)
+        self.order_for_myid[myid] = o
 
     def get_order(self, myid):
         return self.order_for_myid[myid]
 
+    def get_open_orders(self):
+        """取消中を含む未約定の注文"""
+        return self.orders.with_status(*Inventory.PENDING_STATUS)
+
     def get_active_orders(self):
-        return [o for o in self.order_for_myid.values() if o['status'] in Inventory.OPEN_STATUS]
+        return [o for o in self.orders.with_status(*Inventory.OPEN_STATUS) if self.order_for_myid.get(o['myid']) is o]
 
     def get_nonactive_orders(self):
-        my_orders = {o['id']:o for o in self.order_for_myid.values() if o['status'] in Inventory.OPEN_STATUS}
-        return [o for o in list(self.active_orders.values())+list(self.nonactive_orders.values()) if o['id'] not in my_orders]
+        return [o for o in self.get_open_orders() if self.order_for_myid.get(o['myid']) is not o or o['status'] not in Inventory.OPEN_STATUS]
+
+    def reserved(self, base, quote):
+        """未約定の注文で拘束されている数量 (売りは基軸通貨、買いは決済通貨)"""
+        orders = self.get_open_orders()
+        return {
+            base:fsum(o['amount']-o['executed_amount'] for o in orders if o['order_type']=='sell'),
+            quote:fsum((o['amount']-o['executed_amount'])*o['rate'] for o in orders if o['order_type']=='buy'),
+        }
+
+    def pending_amount(self, side):
+        """取消中を含む未約定の注文数量"""
+        return fsum(o['amount']-o['executed_amount'] for o in self.get_open_orders() if o['order_type']==side)
 
     def on_execute(self, o, tr):
         # 注文情報更新
         if tr['id'] not in o['trades']:
-            o['trades'][tr['id']] = tr
-            trades = o['trades'].values()
-            executed_amount = self.spec.round_amount(fsum(t['amount'] for t in trades))
-            average_price = self.spec.round_price(fsum(t['amount']*t['rate'] for t in trades)/executed_amount)
+            # 約定IDのみ保持
+            o['trades'][tr['id']] = True
+            if len(o['trades']) > Inventory.TRADE_IDS_MAXLEN:
+                del o['trades'][next(iter(o['trades']))]
+            amount, notional = self.orders.fills[o['id']]
+            amount.add(tr['amount'])
+            notional.add(tr['amount']*tr['rate'])
+            executed_amount = self.spec.round_amount(amount.value)
+            average_price = self.spec.round_price(notional.value/executed_amount)
             remaining_amount = self.spec.round_amount(o['amount']-executed_amount)
             o['executed_amount'] = executed_amount
             o['average_price'] = average_price
@@ -125,20 +296,54 @@ class Inventory:
         while True:
             try:
                 # 5分待ち
-                await asyncio.sleep(300)
-                # ノンアクティブオーダー削除
-                self.logger.info('Remove Nonactive Orders active {0} nonactive {1}'.format(len(self.active_orders),len(self.nonactive_orders)))
-                active_orders = {k:v for k,v in self.active_orders.items() if v['status'] in Inventory.OPEN_STATUS}
-                nonactive_orders = {k:v for k,v in self.active_orders.items() if v['status'] not in Inventory.OPEN_STATUS}
-                self.active_orders = active_orders
-                self.nonactive_orders = nonactive_orders
+                await self.clock.sleep(300)
+                # 保持期間を過ぎた注文を削除
+                self.orders.prune()
+                self.logger.info('Remove Nonactive Orders open {0} cancelling {1} terminated {2}'.format(
+                    self.orders.count('open'),
+                    self.orders.count('cancelling'),
+                    self.orders.count(*Inventory.TERMINAL_STATUS)))
             except Exception as e:
                 self.logger.exception(e)
 
     def check_my_trades(self,trades):
         trades = sorted(trades, key=itemgetter('id'))
         for e in trades:
-            order_id = e['order_id']
-            order = self.active_orders.get(order_id,None) or self.nonactive_orders.get(order_id,None)
+            self.balance.apply(e)
+            order = self.orders.get(e['order_id'])
             if order:
                 self.on_execute(order,e)
+
+if __name__ == "__main__":
+    from .exchange import Exchange
+    from .utils import stop_watch
+
+    spec = Exchange.ProductSpecs['btc_jpy']
+    lots = [{'id':i,'side':'buy','amount':0.001,'rate':5000000.0+i} for i in range(10000)]
+
+    def full_summary(position):
+        """全建玉を走査する集計 (比較用)"""
+        positions = list(position.positions)
+        long_size = spec.round_amount(fsum(p['amount'] for p in positions if p['side']=='buy'))
+        short_size = spec.round_amount(fsum(p['amount'] for p in positions if p['side']=='sell'))
+        avg = spec.round_price(fsum(p['rate']*p['amount'] for p in positions)/(long_size+short_size))
+        return long_size, short_size, avg
+
+    @stop_watch
+    def running_summary_10k():
+        position = Inventory.Position(spec)
+        for p in lots:
+            position.add(p)
+        return position
+
+    @stop_watch
+    def full_summary_10k():
+        position = Inventory.Position(spec)
+        for p in lots:
+            position.positions.append(p.copy())
+            full_summary(position)
+        return position
+
+    position = running_summary_10k()
+    full_summary_10k()
+    print(position.long_size, position.position_avg_price, full_summary(position))
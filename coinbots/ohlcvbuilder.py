@@ -1,39 +1,153 @@
 # -*- coding: utf-8 -*-
 import pandas as pd
 import numpy as np
-from collections import deque, defaultdict
 from datetime import datetime
 from .utils import dotdict
+from .streaming import Streaming
 from math import sqrt
 
 class OHLCVBuilder:
 
-    def __init__(self, maxlen=100, timeframe=60, disable_rich_ohlcv=False):
+    class RingBuffer:
+        """固定長リングバッファ
+
+        2倍長の領域に同じ値を二重に書き込むことで、直近maxlen件を
+        常に連続したビューとしてコピーなしで返す。
+        返したビューは次のappendで最古の要素が上書きされる。
+        """
+
+        def __init__(self, maxlen, dtype=np.float64):
+            self.maxlen = maxlen
+            self.buf = np.zeros(maxlen*2, dtype=dtype)
+            self.count = 0
+
+        def append(self, value):
+            pos = self.count % self.maxlen
+            self.buf[pos] = value
+            self.buf[pos+self.maxlen] = value
+            self.count += 1
+
+        def view(self):
+            n = min(self.count, self.maxlen)
+            end = (self.count-1) % self.maxlen + self.maxlen + 1 if self.count else self.maxlen
+            return self.buf[end-n:end]
+
+        def __len__(self):
+            return min(self.count, self.maxlen)
+
+    class Columns(dict):
+        """カラム名ごとのリングバッファ (件数のカラムは整数型)"""
+
+        DTYPES = {
+            'buy_count':np.int64,
+            'sell_count':np.int64,
+            'trades':np.int64,
+            'imbalance':np.int64,
+        }
+
+        def __init__(self, maxlen):
+            super().__init__()
+            self.maxlen = maxlen
+
+        def __missing__(self, key):
+            buf = OHLCVBuilder.RingBuffer(self.maxlen, self.DTYPES.get(key, np.float64))
+            self[key] = buf
+            return buf
+
+    class RichOHLCV:
+        """カラムのビューを保持し、pandasの機能が必要になった時だけDataFrameを作る"""
+
+        def __init__(self, columns):
+            self._columns = columns
+            self._series = {}
+            self._frame = None
+
+        def __getattr__(self, attr):
+            if attr.startswith('_'):
+                raise AttributeError(attr)
+            if attr in self._columns:
+                return self[attr]
+            return getattr(self.to_frame(), attr)
+
+        def __getitem__(self, key):
+            series = self._series.get(key)
+            if series is None:
+                if key not in self._columns:
+                    return self.to_frame()[key]
+                series = pd.Series(self._columns[key], name=key, copy=False)
+                self._series[key] = series
+            return series
+
+        def __contains__(self, key):
+            return key in self._columns
+
+        def __iter__(self):
+            return iter(self._columns)
+
+        def __len__(self):
+            for v in self._columns.values():
+                return len(v)
+            return 0
+
+        def to_frame(self):
+            if self._frame is None:
+                self._frame = pd.DataFrame({k:self[k] for k in self._columns}, copy=False)
+            return self._frame
+
+    def __init__(self, maxlen=100, timeframe=60, disable_rich_ohlcv=False, indicators=None):
         self.disable_rich_ohlcv = disable_rich_ohlcv
-        self.ohlcv = defaultdict(lambda:deque(maxlen=maxlen))
+        self.ohlcv = OHLCVBuilder.Columns(maxlen)
         self.last = None
         self.timeframe = timeframe
+        self.indicators = {}
+        for name, indicator in (indicators or {}).items():
+            self.add_indicator(name, indicator)
+
+    def add_indicator(self, name, indicator):
+        """逐次計算インジケーターを登録し、足の確定ごとにカラムとして追加する"""
+        self.indicators[name] = indicator
+        # 既存の足で初期化
+        history = {k:v.view().copy() for k,v in self.ohlcv.items()}
+        for i in range(len(history.get('close',[]))):
+            self._update_indicator(name, indicator, {k:v[i] for k,v in history.items()})
+
+    def _update_indicator(self, name, indicator, bar):
+        value = indicator.on_bar(bar)
+        if indicator.fields:
+            for field, v in zip(indicator.fields, value):
+                self.ohlcv[name+'_'+field].append(v)
+        else:
+            self.ohlcv[name].append(value)
 
     def create_boundary_ohlcv(self, executions):
+        columnar = isinstance(executions, Streaming.TradeBatch)
         if len(executions)==0:
             if self.last is not None:
                 e = self.last.copy()
                 e['amount'] = 0
                 e['order_type'] = ''
-                executions.append(e)
+                if columnar:
+                    executions = Streaming.TradeBatch.from_trades([e])
+                else:
+                    executions.append(e)
         if len(executions):
-            self.last = executions[-1]
-            for k,v in self.make_ohlcv(executions).items():
+            if columnar:
+                self.last = executions.last()
+                bar = self.make_ohlcv_columnar(executions)
+            else:
+                self.last = executions[-1]
+                bar = self.make_ohlcv(executions)
+            for k,v in bar.items():
                 self.ohlcv[k].append(v)
+            for name, indicator in self.indicators.items():
+                self._update_indicator(name, indicator, bar)
         return self.to_rich_ohlcv()
 
     def to_rich_ohlcv(self):
-        rich_ohlcv = dotdict()
-        for k,v in self.ohlcv.items():
-            rich_ohlcv[k] = np.array(v)
-        if not self.disable_rich_ohlcv:
-            rich_ohlcv = pd.DataFrame.from_dict(rich_ohlcv)
-        return rich_ohlcv
+        columns = {k:v.view() for k,v in self.ohlcv.items()}
+        if self.disable_rich_ohlcv:
+            return dotdict(columns)
+        return OHLCVBuilder.RichOHLCV(columns)
 
     def make_ohlcv(self, executions):
         price = [e['rate'] for e in executions]
@@ -54,3 +168,24 @@ class OHLCVBuilder:
         ohlcv.imbalance = ohlcv.buy_count - ohlcv.sell_count
         ohlcv.average = sum(price) / len(price)
         return ohlcv
+
+    def make_ohlcv_columnar(self, executions):
+        price = executions.rate
+        amount = executions.amount
+        buy = executions.side == 1
+        sell = executions.side == -1
+        ohlcv = dotdict()
+        ohlcv.open = float(price[0])
+        ohlcv.high = float(price.max())
+        ohlcv.low = float(price.min())
+        ohlcv.close = float(price[-1])
+        ohlcv.buy_volume = float(amount[buy].sum())
+        ohlcv.sell_volume = float(amount[sell].sum())
+        ohlcv.volume = ohlcv.buy_volume + ohlcv.sell_volume
+        ohlcv.volume_imbalance = ohlcv.buy_volume - ohlcv.sell_volume
+        ohlcv.buy_count = int(np.count_nonzero(buy))
+        ohlcv.sell_count = int(np.count_nonzero(sell))
+        ohlcv.trades = ohlcv.buy_count + ohlcv.sell_count
+        ohlcv.imbalance = ohlcv.buy_count - ohlcv.sell_count
+        ohlcv.average = float(price.mean())
+        return ohlcv
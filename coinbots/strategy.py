@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
 import logging
 import asyncio
+import aiohttp
 from .utils import dotdict
 from .streaming import Streaming
 from .ohlcvbuilder import OHLCVBuilder
 from .inventory import Inventory
 from .exchange import Exchange, ExchangeError
 from .board import Board
+from .tracing import tracer
+from .clock import Clock
 from collections import deque, defaultdict
 from datetime import datetime, timedelta, timezone
-from time import time
+from math import fsum
 
 class Strategy:
 
@@ -23,19 +26,58 @@ class Strategy:
         self.settings.apiKey = ''
         self.settings.secret = ''
         self.settings.symbol = 'BTC/JPY'
+        # APIのレート制限 {'public'|'private': (1秒あたり, バースト)}
+        self.settings.rate_limits = None
 
         # 動作タイミング
         self.settings.interval = interval
         self.settings.minimum_interval = 0
 
+        # 注文設定
+        # キャンセルと新規注文を同時に発行する
+        self.settings.concurrent_requote = False
+        # 同時発行時に許容する片側の最大建玉+注文数量 (Noneなら無制限)
+        self.settings.max_exposure = None
+        # set_quotesで既存注文を残す価格・サイズの許容差
+        self.settings.quote_price_tolerance = 0
+        self.settings.quote_size_tolerance = 0
+        # 一括キャンセルの同時実行数・リトライ回数・完了待ち時間
+        self.settings.cancel_concurrency = 4
+        self.settings.cancel_retries = 3
+        self.settings.cancel_all_timeout = 30
+
+        # 約定同期設定 (注文中/ノーポジ時のポーリング間隔・取得件数)
+        self.settings.trade_sync_interval = 1
+        self.settings.trade_sync_idle_interval = 10
+        self.settings.trade_sync_limit = 100
+        # 重複除去のために覚えておく約定IDの数
+        self.settings.trade_sync_seen_maxlen = 1000
+
+        # 残高をREST APIと突き合わせる間隔・取得中に約定した場合のリトライ回数
+        self.settings.balance_reconcile_interval = 300
+        self.settings.balance_reconcile_retries = 3
+
         # OHLCV設定
         self.settings.max_ohlcv_size = 1000
         self.settings.disable_rich_ohlcv = False
+        self.settings.indicators = {}
+
+        # ストリーム配信設定 (socketio/websocket/hedged)
+        self.settings.streaming_source = 'socketio'
+        # 約定を列指向(TradeBatch)で受け取る
+        self.settings.columnar_executions = False
 
         # その他設定
         self.settings.enable_board = False
         self.settings.enable_board_api = False
 
+        # レイテンシ計測
+        self.settings.enable_tracing = False
+        self.settings.tracing_interval = 60
+
+        # 時計 (バックテストではSimClockに差し替える)
+        self.clock = Clock()
+
         # ログ設定
         self.logger = logging.getLogger(__name__)
 
@@ -47,24 +89,25 @@ class Strategy:
         self.spec = Exchange.ProductSpecs[self.pair]
 
         # APIセットアップ
-        self.api = Exchange(self.settings.apiKey, self.settings.secret)
+        self.api = Exchange(self.settings.apiKey, self.settings.secret, self.settings.rate_limits)
 
         # ストリーム配信
-        self.streaming = Streaming(Streaming.SocketioSource())
-        self.executions_ep = await self.streaming.get_trades_endpoint(self.pair, 5000)
-
-        # OHLCVビルダー設定
-        self.ohlcvbuilder = OHLCVBuilder(
-            maxlen=self.settings.max_ohlcv_size,
-            disable_rich_ohlcv=self.settings.disable_rich_ohlcv)
-
-        # 注文管理
-        self.inventory = Inventory(self.spec)
-        self.latest_trade_id = None
+        sources = {
+            'socketio': Streaming.SocketioSource,
+            'websocket': Streaming.WebsocketSource,
+            'hedged': Streaming.HedgedSource,
+        }
+        self.streaming = Streaming(sources[self.settings.streaming_source](), api=self.api.api)
+        if self.settings.columnar_executions:
+            self.executions_ep = await self.streaming.get_trades_columnar_endpoint(self.pair, 5000)
+        else:
+            self.executions_ep = await self.streaming.get_trades_endpoint(self.pair, 5000)
+
+        self.setup()
 
         # 板情報（配信）
         if self.settings.enable_board:
-            self.board = Board(self.pair)
+            self.board = Board(self.pair, api=self.api)
             ob = await self.api.orderbooks(self.pair)
             self.board.sync(ob)
             await self.board.attach(self.streaming)
@@ -73,34 +116,137 @@ class Strategy:
             self.board = Board(self.pair)
 
         # ロジック実行
-        await asyncio.wait([
+        tasks = [
             self.balance_polling(),
+            self.trade_polling(),
             self.cancel_nonactive_orders(),
             self.standard_logic(),
             self.inventory.start(),
-            self.streaming.start()])
+            self.streaming.start()]
+        if self.settings.enable_tracing:
+            tracer.enabled = True
+            tasks.append(tracer.report(self.settings.tracing_interval))
+        await asyncio.wait(tasks)
+
+    def setup(self):
+        """OHLCVビルダーと注文管理の初期化 (バックテストと共通)"""
+        # OHLCVビルダー設定
+        self.ohlcvbuilder = OHLCVBuilder(
+            maxlen=self.settings.max_ohlcv_size,
+            disable_rich_ohlcv=self.settings.disable_rich_ohlcv,
+            indicators=self.settings.indicators)
+
+        # 注文管理
+        self.inventory = Inventory(self.spec, self.clock)
+        self.balance = dotdict()
+        self.latest_trade_id = None
+        self.seen_trade_ids = set()
+        self.seen_trade_queue = deque()
+        self.trade_sync_wakeup = asyncio.Event()
 
     def get_order(self, myid):
         return self.inventory.get_order(myid)
 
-    async def order(self, myid, side, size, limit=None, cancel_after_seconds=None, limit_mask=0):
+    async def order(self, myid, side, size, limit=None, cancel_after_seconds=None, limit_mask=0, concurrent=None):
+        if concurrent is None:
+            concurrent = self.settings.concurrent_requote
         # 注文がオープンならキャンセル
         o = self.inventory.get_order(myid)
         if o['status'] in Inventory.OPEN_STATUS:
             if abs(o['rate']-limit)>limit_mask or abs(o['amount']-size)>0:
-                try:
-                    self.logger.info('CANCEL {myid} {status} {order_type} {rate} {executed_amount}/{amount} {id}'.format(**o))
-                    await self.api.cancel(o)
-                except ExchangeError as e:
-                    self.logger.warning(type(e).__name__ + ": {0}".format(e))
+                if concurrent and self.exposure_allowed(side, size):
+                    # キャンセルと新規注文を同時に発行
+                    await asyncio.gather(
+                        self._cancel_order(o),
+                        self._new_order(myid, side, size, limit, cancel_after_seconds))
+                    return
+                await self._cancel_order(o)
             else:
                 # 価格・サイズが同じなら注文しない
                 return
 
         # 新規注文
+        await self._new_order(myid, side, size, limit, cancel_after_seconds)
+
+    async def requote(self, orders, cancels=()):
+        """複数の注文・キャンセルをまとめて同時に発行する
+
+        orders: order()の引数の辞書のリスト
+        cancels: キャンセルするmyidのリスト
+        """
+        await asyncio.gather(
+            *[self.order(**o) for o in orders],
+            *[self.cancel(myid) for myid in cancels])
+
+    async def set_quotes(self, quotes, price_tolerance=None, size_tolerance=None):
+        """出しておきたい注文の全体を指定し、現在の注文との差分だけを発行する
+
+        quotes: {'side','size','limit'} (任意で'myid') のリスト
+        許容範囲内の既存注文はそのまま残して板の順番を保つ。
+        """
+        if price_tolerance is None:
+            price_tolerance = self.settings.quote_price_tolerance
+        if size_tolerance is None:
+            size_tolerance = self.settings.quote_size_tolerance
+        # 発注時と同じ丸めで比較する (呼び出し元の辞書は変更しない)
+        quotes = [dict(q, limit=self.spec.round_price(q['limit']), size=self.spec.round_amount(q['size'])) for q in quotes]
+        active = self.inventory.get_active_orders()
+        kept, cancels, news = [], [], []
+        for side in ('buy','sell'):
+            existing = [o for o in active if o['order_type']==side]
+            for q in quotes:
+                if q['side'] != side:
+                    continue
+                best = None
+                for o in existing:
+                    price_diff = abs(o['rate']-q['limit'])
+                    if price_diff<=price_tolerance and abs(self.spec.round_amount(o['amount']-o['executed_amount'])-q['size'])<=size_tolerance:
+                        if best is None or price_diff<abs(best['rate']-q['limit']):
+                            best = o
+                if best is not None:
+                    existing.remove(best)
+                    kept.append(best)
+                else:
+                    news.append(q)
+            cancels.extend(existing)
+
+        # 新規注文のmyidを決める
+        used = {o['myid'] for o in kept}
+        seq = 0
+        for q in news:
+            myid = q.get('myid')
+            while myid is None or myid in used:
+                seq += 1
+                myid = q['side'][0].upper()+str(seq)
+            used.add(myid)
+            q['myid'] = myid
+
+        cancel_jobs = [self._cancel_order(o) for o in cancels]
+        order_jobs = [self._new_order(q['myid'], q['side'], q['size'], q['limit'], q.get('cancel_after_seconds')) for q in news]
+        concurrent = self.settings.concurrent_requote and all(
+            self.exposure_allowed(side, fsum(q['size'] for q in news if q['side']==side)) for side in ('buy','sell'))
+        if concurrent:
+            await asyncio.gather(*cancel_jobs, *order_jobs)
+        else:
+            await asyncio.gather(*cancel_jobs)
+            await asyncio.gather(*order_jobs)
+        return dotdict({'kept':len(kept),'cancelled':len(cancels),'placed':len(news)})
+
+    def exposure_allowed(self, side, size):
+        """キャンセル中の注文が約定しても最大エクスポージャーを超えないか"""
+        max_exposure = self.settings.max_exposure
+        if max_exposure is None:
+            return True
+        position = self.inventory.position.position_size
+        if side == 'sell':
+            position = -position
+        return position + self.inventory.pending_amount(side) + size <= max_exposure
+
+    async def _new_order(self, myid, side, size, limit, cancel_after_seconds=None):
         try:
             res = await self.api.order(self.pair,side,size,limit)
             self.inventory.new_order(myid,res)
+            self.trade_sync_wakeup.set()
             o = self.inventory.get_order(myid)
             self.logger.info('NEW {myid} {status} {order_type} {rate} {executed_amount}/{amount} {id}'.format(**o))
             # 後でキャンセル
@@ -109,9 +255,16 @@ class Strategy:
         except ExchangeError as e:
             self.logger.warning(type(e).__name__ + ": {0}".format(e))
 
+    async def _cancel_order(self, o, label='CANCEL'):
+        try:
+            self.logger.info(label+' {myid} {status} {order_type} {rate} {executed_amount}/{amount} {id}'.format(**o))
+            await self.api.cancel(o)
+        except ExchangeError as e:
+            self.logger.warning(type(e).__name__ + ": {0}".format(e))
+
     async def _cancel_later(self, o, seconds):
         try:
-            await asyncio.sleep(seconds)
+            await self.clock.sleep(seconds)
             if o['status'] in Inventory.OPEN_STATUS:
                 self.logger.info('CANCEL LATER {myid} {status} {order_type} {rate} {executed_amount}/{amount} {id}'.format(**o))
                 await self.api.cancel(o)
@@ -124,49 +277,151 @@ class Strategy:
         # 注文がオープンならキャンセル
         o = self.inventory.get_order(myid)
         if o['status'] in Inventory.OPEN_STATUS:
-            try:
-                self.logger.info('CANCEL {myid} {status} {order_type} {rate} {executed_amount}/{amount} {id}'.format(**o))
-                await self.api.cancel(o)
-            except ExchangeError as e:
-                self.logger.warning(type(e).__name__ + ": {0}".format(e))
+            await self._cancel_order(o)
+
+    async def cancel_orders(self, orders, label='CANCEL'):
+        """注文を同時実行数を制限して並列にキャンセルする 通信エラーはリトライする"""
+        sem = asyncio.Semaphore(self.settings.cancel_concurrency)
+        async def _cancel(o):
+            async with sem:
+                for retry in range(self.settings.cancel_retries+1):
+                    try:
+                        self.logger.info(f'{label} {o.get("myid","-")} {o["order_type"]} {o["rate"]} {o["id"]}')
+                        await self.api.cancel(o)
+                        return True
+                    except ExchangeError as e:
+                        self.logger.warning(type(e).__name__ + ": {0}".format(e))
+                        # 取消済みか確認
+                        try:
+                            status = await self.api.cancel_status(o['id'])
+                            if status.get('cancel'):
+                                o['status'] = 'cancel'
+                                return True
+                        except ExchangeError as e:
+                            self.logger.warning(type(e).__name__ + ": {0}".format(e))
+                        return False
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        self.logger.warning(type(e).__name__ + ": {0}".format(e))
+                        await self.clock.sleep(0.5 * 2 ** retry)
+                return False
+        return await asyncio.gather(*[_cancel(o) for o in orders])
 
     async def cancel_order_all(self):
-        pass
+        """全注文をキャンセルし、未約定注文が無くなるまで確認する"""
+        start = self.clock.time()
+        cancelled = failed = 0
+        remaining = None
+        # 手元で把握している注文は取引所への問い合わせを待たずにキャンセル
+        known = {o['id']:o for o in self.inventory.get_open_orders()}
+        results = await self.cancel_orders(list(known.values()), 'CANCEL ALL')
+        cancelled += sum(results)
+        while self.clock.time() - start < self.settings.cancel_all_timeout:
+            try:
+                open_orders = [o for o in await self.api.get_orders() if o['pair']==self.pair]
+            except (ExchangeError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.logger.warning(type(e).__name__ + ": {0}".format(e))
+                await self.clock.sleep(1)
+                continue
+            remaining = len(open_orders)
+            if remaining == 0:
+                break
+            results = await self.cancel_orders([known.get(o['id'],o) for o in open_orders], 'CANCEL ALL')
+            cancelled += sum(results)
+            failed += len(results) - sum(results)
+            await self.clock.sleep(1)
+        elapsed = self.clock.time() - start
+        self.logger.info(f'CANCEL ALL cancelled {cancelled} failed {failed} remaining {remaining} time to flat {elapsed:.3f}s')
+        return dotdict({'cancelled':cancelled,'failed':failed,'remaining':remaining,'time':elapsed})
 
     async def check_balance(self):
+        """ローカルの残高をREST APIの残高と突き合わせる"""
         try:
-            ticker = await self.api.ticker(pair=self.pair)
-            balance = await self.api.balance()
-            btc = balance['btc']+balance['btc_reserved']
-            jpy = balance['jpy']+balance['jpy_reserved']
-            total = int(jpy + ticker['bid']*btc)
-            balance['jpy_total'] = total
-            self.balance = dotdict(balance)
-            self.logger.info(f'btc {btc:.8f} jpy {jpy:.0f} total {total}')
+            currencies = self.pair.split('_')
+            retries = self.settings.balance_reconcile_retries
+            for _ in range(retries + 1):
+                # 取得前の約定は反映しておく
+                await self.check_trades()
+                applied = self.inventory.balance.applied
+                balance = await self.api.balance()
+                # 取得中の約定を反映し、なければ残高は一致しているはず
+                await self.check_trades()
+                if applied == self.inventory.balance.applied:
+                    break
+            else:
+                # 約定が続いている場合は次回に持ち越し
+                self.logger.warning(f'balance reconcile skipped: trades applied during {retries + 1} attempts')
+                return
+            drift = self.inventory.balance.sync(balance, currencies)
+            self.update_balance()
+            self.logger.info(' '.join(f'{c} {self.inventory.balance.funds[c].value:.8f}' for c in currencies) +
+                ' drift ' + ' '.join(f'{c} {v:.8f}' for c, v in drift.items()))
         except ExchangeError as e:
             self.logger.warning(type(e).__name__ + ": {0}".format(e))
 
+    def update_balance(self):
+        """ローカルの残高を直近の約定価格で時価評価する"""
+        if self.inventory.balance.synced:
+            base, quote = self.pair.split('_')
+            last = self.ohlcvbuilder.last
+            self.balance = dotdict(self.inventory.balance.get(base, quote, last['rate'] if last else None,
+                self.inventory.reserved(base, quote)))
+
     async def check_trades(self):
+        """前回の続きから自分の約定を取得してInventoryに反映する"""
         try:
-            trades = await self.api.get_my_trades(end=self.latest_trade_id)
-            if len(trades):
-                self.latest_trade_id = max(t['id'] for t in trades)
-            self.inventory.check_my_trades(trades)
+            if self.latest_trade_id is None:
+                # 起動前の約定は対象外
+                trades = await self.api.get_my_trades(count=1)
+                self.latest_trade_id = max((t['id'] for t in trades), default=0)
+                return
+            limit = self.settings.trade_sync_limit
+            while True:
+                trades = await self.api.get_my_trades(count=limit, since=self.latest_trade_id, order='asc')
+                if len(trades) == 0:
+                    break
+                self.latest_trade_id = max(self.latest_trade_id, max(t['id'] for t in trades))
+                new_trades = []
+                for t in trades:
+                    if t['pair'] == self.pair and t['id'] not in self.seen_trade_ids:
+                        self.seen_trade_ids.add(t['id'])
+                        self.seen_trade_queue.append(t['id'])
+                        new_trades.append(t)
+                while len(self.seen_trade_queue) > self.settings.trade_sync_seen_maxlen:
+                    self.seen_trade_ids.discard(self.seen_trade_queue.popleft())
+                self.inventory.check_my_trades(new_trades)
+                # 続きのページがなければ終了
+                if len(trades) < limit:
+                    break
         except ExchangeError as e:
             self.logger.warning(type(e).__name__ + ": {0}".format(e))
 
+    async def trade_polling(self):
+        while True:
+            try:
+                await self.check_trades()
+            except Exception as e:
+                self.logger.exception(e)
+            # 注文中は短い間隔、ノーポジかつ注文なしなら長い間隔
+            if len(self.inventory.get_open_orders()) or self.inventory.position.position_size:
+                interval = self.settings.trade_sync_interval
+            else:
+                interval = self.settings.trade_sync_idle_interval
+            # 新規注文で待ちを打ち切る
+            await self.clock.wait(self.trade_sync_wakeup, interval)
+            self.trade_sync_wakeup.clear()
+
     async def balance_polling(self):
         while True:
-            await asyncio.sleep(300)
             try:
-                # 定期的に資産情報取得
+                # 定期的に資産情報を突き合わせ
                 await self.check_balance()
             except Exception as e:
                 self.logger.exception(e)
+            await self.clock.sleep(self.settings.balance_reconcile_interval)
 
     async def cancel_nonactive_orders(self):
         while True:
-            await asyncio.sleep(15)
+            await self.clock.sleep(15)
             try:
                 # 最近の注文情報取得
                 recent_orders = self.inventory.get_nonactive_orders()
@@ -179,12 +434,7 @@ class Strategy:
                     # アクティブ注文を全てキャンセル
                     cancel_needed = [o for o in recent_orders if o['id'] in open_orders]
                     if len(cancel_needed):
-                        for o in cancel_needed:
-                            try:
-                                self.logger.info('FORCED CANCEL {myid} {status} {order_type} {rate} {executed_amount}/{amount} {id}'.format(**o))
-                                await self.api.cancel(o)
-                            except ExchangeError as e:
-                                self.logger.warning(type(e).__name__ + ": {0}".format(e))
+                        await self.cancel_orders(cancel_needed, 'FORCED CANCEL')
 
             except ExchangeError as e:
                 self.logger.warning(type(e).__name__ + ": {0}".format(e))
@@ -193,23 +443,23 @@ class Strategy:
 
     async def standard_logic(self):
         try:
-            await self.check_balance()
             await self.executions_ep.wait()
         except Exception as e:
             self.logger.exception(e)
-        last_entry_time = time()
+        last_entry_time = self.clock.time()
         while True:
             try:
                 # 待ち
                 if self.settings.interval:
-                    await asyncio.sleep((-time() % self.settings.interval) or self.settings.interval)
+                    now = self.clock.time()
+                    await self.clock.sleep((-now % self.settings.interval) or self.settings.interval)
                 else:
                     await self.executions_ep.wait()
 
                 # 最小インターバル
                 if self.settings.minimum_interval:
                     t1 = last_entry_time // self.settings.minimum_interval
-                    t2 = time() // self.settings.minimum_interval
+                    t2 = self.clock.time() // self.settings.minimum_interval
                     can_entry = t2 > t1
                 else:
                     can_entry = True
@@ -219,38 +469,43 @@ class Strategy:
                     if self.settings.enable_board_api:
                         ob = await self.api.orderbooks(self.pair)
                         self.board.sync(ob)
-                    await self.check_trades()
-
-                # ポジション情報コピー
-                self.long_size = self.inventory.position.long_size
-                self.short_size = self.inventory.position.short_size
-                self.position_size = self.inventory.position.position_size
-                self.position_avg_price = self.inventory.position.position_avg_price
 
                 # 約定履歴取得
                 executions = await self.executions_ep.get_data()
-                ohlcv = self.ohlcvbuilder.create_boundary_ohlcv(executions)
 
                 # ロジックコール
                 if can_entry:
-                    last_entry_time = time()
-                    if self.settings.enable_board:
-                        board = self.board
-                        bids, asks = board.sort()
-                        bid, ask = bids[0]['price'], asks[0]['price']
-                        spread = ask - bid
-                        if spread<-50:
-                            self.logger.warning(f'orderbooks needs to be sync. spr {spread} bid {bid} ask {ask}')
-                            ob = await self.api.orderbooks(self.pair)
-                            board.sync(ob)
-                    elif self.settings.enable_board_api:
-                        board = self.board
-                    else:
-                        board = None
-                    await self.yourlogic(
-                        executions=executions,
-                        ohlcv=ohlcv,
-                        board=board,
-                        strategy=self)
+                    last_entry_time = self.clock.time()
+                await self.on_tick(executions, can_entry)
             except Exception as e:
                 self.logger.exception(e)
+
+    async def on_tick(self, executions, can_entry=True):
+        """足を確定し、必要ならロジックを呼ぶ"""
+        # ポジション情報コピー
+        self.long_size = self.inventory.position.long_size
+        self.short_size = self.inventory.position.short_size
+        self.position_size = self.inventory.position.position_size
+        self.position_avg_price = self.inventory.position.position_avg_price
+
+        ohlcv = self.ohlcvbuilder.create_boundary_ohlcv(executions)
+        self.update_balance()
+
+        if can_entry:
+            if self.settings.enable_board:
+                board = self.board
+            elif self.settings.enable_board_api:
+                board = self.board
+            else:
+                board = None
+            if tracer.enabled:
+                tracer.since('logic_start','recv')
+                tracer.marks['logic_recv'] = tracer.marks.get('recv')
+                tracer.mark('logic')
+            await self.yourlogic(
+                executions=executions,
+                ohlcv=ohlcv,
+                board=board,
+                strategy=self)
+            if tracer.enabled:
+                tracer.since('logic','logic')
@@ -3,26 +3,139 @@ import aiohttp
 import asyncio
 import logging
 import json
+import random
+import numpy as np
 import socketio
+import struct
 from datetime import datetime
-from collections import deque, defaultdict
-from time import time
+from collections import deque, defaultdict, OrderedDict
+from time import time, monotonic
+from .cctypes import type_converter
+from .utils import dotdict
+from .tracing import tracer
 
 class Streaming:
 
-    def __init__(self, source):
+    def __init__(self, source, record=None, api=None):
         self.logger = logging.getLogger(__name__)
         self.source = source
+        self.recorder = None
+        if record:
+            # 受信フレームを記録
+            self.recorder = Streaming.Recorder(record)
+            self.source.recorder = self.recorder
         self.running = False
+        self.connected = False
         self.subscribed_channels = {}
         self.endpoints = []
         self.callbacks = defaultdict(list)
         self.on_connect = None
+        # 約定の欠損補完 (api: CCAPI)
+        self.api = api
+        self.max_trade_id_gap = 100
+        self.backfill_limit = 100
+        self.last_trade_id = {}
+        self._backfilling = {}
+        self.stats = dotdict({
+            'reconnects':0,
+            'gaps':0,
+            'backfills':0,
+            'backfilled_trades':0,
+            'recovery_time':0,
+        })
 
     async def _on_data(self,channel,data):
+        if self.api and (channel.endswith('-trades') or channel.endswith('-trades-v2')):
+            await self._on_trades(channel,data)
+        else:
+            await self._dispatch(channel,data)
+
+    async def _dispatch(self,channel,data):
+        if tracer.enabled:
+            tracer.since('dispatch','recv')
         for cb in self.callbacks[channel]:
             await cb(channel,data)
 
+    async def _on_trades(self,channel,data):
+        pair = channel.split('-')[0]
+        buffered = self._backfilling.get(pair)
+        if buffered is not None:
+            # 補完中の約定は補完後に配信する
+            buffered.append((channel,data))
+            return
+        trades = data if isinstance(data,list) else [data]
+        if len(trades)==0:
+            return
+        last = self.last_trade_id.get(channel)
+        if last is not None and trades[0]['id']-last > self.max_trade_id_gap:
+            self.stats.gaps += 1
+            self.logger.warning(f'trade id gap {pair} {last} -> {trades[0]["id"]}')
+            self._start_backfill(pair, last, trades[0]['id'])
+            self._backfilling[pair].append((channel,data))
+            return
+        await self._dispatch_trades(channel,data)
+
+    async def _dispatch_trades(self,channel,data):
+        # 配信済みの約定は除く (チャンネルごとに管理)
+        last = self.last_trade_id.get(channel)
+        if isinstance(data,list):
+            if last is not None:
+                data = [t for t in data if t['id']>last]
+            if len(data)==0:
+                return
+            self.last_trade_id[channel] = data[-1]['id']
+        else:
+            if last is not None and data['id']<=last:
+                return
+            self.last_trade_id[channel] = data['id']
+        await self._dispatch(channel,data)
+
+    def _start_backfill(self, pair, since, until=None):
+        if pair not in self._backfilling:
+            self._backfilling[pair] = []
+            asyncio.ensure_future(self._backfill(pair, since, until))
+
+    async def _backfill(self, pair, since, until=None):
+        """REST APIで since より後の約定を取得して配信する"""
+        start = monotonic()
+        count = 0
+        try:
+            cursor = since
+            while True:
+                res = await self.api.trades(pair=pair, limit=self.backfill_limit, order='desc', ending_before=cursor)
+                trades = type_converter(res.get('data',[]))
+                trades = sorted((t for t in trades if t['id']>cursor), key=lambda t:t['id'])
+                if until is not None:
+                    trades = [t for t in trades if t['id']<until]
+                if len(trades)==0:
+                    break
+                trades = [{'id':t['id'],'pair':pair,'rate':t['rate'],'amount':t['amount'],'order_type':t['order_type']} for t in trades]
+                if pair+'-trades-v2' in self.callbacks:
+                    await self._dispatch_trades(pair+'-trades-v2',trades)
+                if pair+'-trades' in self.callbacks:
+                    for t in trades:
+                        await self._dispatch_trades(pair+'-trades',t)
+                count += len(trades)
+                cursor = trades[-1]['id']
+                if len(trades) < self.backfill_limit:
+                    break
+        except Exception as e:
+            self.logger.exception(e)
+        finally:
+            # 補完中に受信した約定を配信
+            buffered = self._backfilling[pair]
+            while len(buffered):
+                channel, data = buffered.pop(0)
+                await self._dispatch_trades(channel,data)
+            del self._backfilling[pair]
+        elapsed = monotonic() - start
+        disconnected_at = getattr(self.source,'disconnected_at',None)
+        recovery = monotonic() - disconnected_at if disconnected_at else elapsed
+        self.stats.backfills += 1
+        self.stats.backfilled_trades += count
+        self.stats.recovery_time = recovery
+        self.logger.info(f'backfilled {count} trades {pair} in {elapsed:.3f}s recovery {recovery:.3f}s')
+
     async def _subscribe_registred_channels(self):
         if len(self.subscribed_channels):
             for _subscribe in self.subscribed_channels.values():
@@ -32,6 +145,18 @@ class Streaming:
         if self.on_connect:
             await self.on_connect()
         await self._subscribe_registred_channels()
+        if self.connected:
+            # 再接続時は切断中の約定を補完
+            self.stats.reconnects += 1
+            if self.api:
+                # 同じペアの複数チャンネルは一番古い位置から補完
+                since = {}
+                for channel, last in self.last_trade_id.items():
+                    pair = channel.split('-')[0]
+                    since[pair] = min(since.get(pair, last), last)
+                for pair, last in since.items():
+                    self._start_backfill(pair, last)
+        self.connected = True
 
     async def add_endpoint(self, channel, endpoint):
         self.endpoints.append(endpoint)
@@ -67,11 +192,15 @@ class Streaming:
         ep = Streaming.BufferedEndpoint(maxlen=maxlen)
         return await self.add_endpoint(pair+'-trades-v2',ep)
 
+    async def get_trades_columnar_endpoint(self, pair, maxlen=5000):
+        ep = Streaming.ColumnarEndpoint(maxlen=maxlen)
+        return await self.add_endpoint(pair+'-trades',ep)
+
     async def start(self):
         if self.running == False:
             self.running = True
             self.logger.info('Start Streaming')
-            await asyncio.wait([self.source.start(self._on_data,self._on_connect,self.logger)])
+            await self.source.start(self._on_data,self._on_connect,self.logger)
             self.logger.info('Stop Streaming')
 
     async def stop(self):
@@ -80,12 +209,66 @@ class Streaming:
             await self.source.stop()
             for ep in self.endpoints:
                 await ep.shutdown()
+            if self.recorder:
+                self.recorder.close()
+
+    class Recorder:
+        """受信フレームの追記型バイナリログ
+
+        1レコード = ヘッダ(monotonic受信時刻 f8, 種別 u1, 長さ u4) + 生フレーム
+        """
+
+        HEADER = struct.Struct('<dBI')
+
+        # フレーム種別
+        START = ord('S')
+        SIO_TRADES = ord('T')
+        SIO_ORDERBOOK = ord('O')
+        WS_MESSAGE = ord('W')
+
+        def __init__(self, path):
+            self.path = path
+            self.file = open(path, 'ab')
+            # monotonic時刻から実時刻へ換算するための基準
+            self.write(Streaming.Recorder.START, str(time()).encode())
+
+        def write(self, kind, payload):
+            self.file.write(Streaming.Recorder.HEADER.pack(monotonic(), kind, len(payload)))
+            self.file.write(payload)
+
+        def close(self):
+            if not self.file.closed:
+                self.file.close()
+
+        @staticmethod
+        def read(path):
+            size = Streaming.Recorder.HEADER.size
+            with open(path, 'rb') as f:
+                while True:
+                    header = f.read(size)
+                    if len(header) < size:
+                        break
+                    t, kind, length = Streaming.Recorder.HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length:
+                        break
+                    yield t, kind, payload
 
     class Source:
         def __init__(self):
-            pass
+            self.recorder = None
+            # 再接続間隔(指数バックオフ)
+            self.retry_delay = 1
+            self.max_retry_delay = 60
+            self.disconnected_at = None
+            # 切断時のコールバック (HedgedSource が使う)
+            self.on_disconnect = None
+
+        def _record(self, kind, payload):
+            if self.recorder:
+                self.recorder.write(kind, payload)
 
-        async def subscribe(self,channel,token):
+        async def subscribe(self,channel):
             pass
 
         async def unsubscribe(self,channel):
@@ -102,13 +285,25 @@ class Streaming:
             self.on_connect = on_connect
             self.logger = logger
             self.running = True
+            attempt = 0
             while self.running:
+                connected_at = monotonic()
                 try:
                     await self._run_loop()
                 except Exception as e:
                     logger.exception(e)
+                if self.on_disconnect:
+                    await self.on_disconnect()
                 if self.running:
-                    await asyncio.sleep(5)
+                    self.disconnected_at = monotonic()
+                    if self.disconnected_at - connected_at > self.max_retry_delay:
+                        # しばらく接続できていたら間隔を戻す
+                        attempt = 0
+                    delay = min(self.retry_delay * 2 ** attempt, self.max_retry_delay)
+                    delay = random.uniform(delay / 2, delay)
+                    attempt += 1
+                    logger.info(f'reconnect in {delay:.1f}s')
+                    await asyncio.sleep(delay)
 
         async def stop(self):
             self.running = False
@@ -129,7 +324,8 @@ class Streaming:
             self.sio_connected = True
             await self.on_connect()
 
-        async def _on_trades(self,trades):
+        @staticmethod
+        def _parse_trades(trades):
             if isinstance(trades[0],list):
                 channel = trades[0][1]+'-trades-v2'
                 dat = [{'id':t[0],'pair':t[1],'rate':float(t[2]),'amount':float(t[3]),'order_type':t[4]} for t in trades]
@@ -137,13 +333,34 @@ class Streaming:
                 t = trades
                 channel = t[1]+'-trades'
                 dat = {'id':t[0],'pair':t[1],'rate':float(t[2]),'amount':float(t[3]),'order_type':t[4]}
-            await self.on_data(channel,dat)
+            return channel, dat
 
-        async def _on_orderbook(self,ob):
+        @staticmethod
+        def _parse_orderbook(ob):
             channel = ob[0]+'-orderbook'
             dat = {}
             dat['asks'] = [[float(b[0]),float(b[1])] for b in ob[1].get('asks',[])]
             dat['bids'] = [[float(b[0]),float(b[1])] for b in ob[1].get('bids',[])]
+            return channel, dat
+
+        async def _on_trades(self,trades):
+            if tracer.enabled:
+                tracer.mark('recv')
+            if self.recorder:
+                self._record(Streaming.Recorder.SIO_TRADES, json.dumps(trades).encode())
+            channel, dat = self._parse_trades(trades)
+            if tracer.enabled:
+                tracer.since('parse','recv')
+            await self.on_data(channel,dat)
+
+        async def _on_orderbook(self,ob):
+            if tracer.enabled:
+                tracer.mark('recv')
+            if self.recorder:
+                self._record(Streaming.Recorder.SIO_ORDERBOOK, json.dumps(ob).encode())
+            channel, dat = self._parse_orderbook(ob)
+            if tracer.enabled:
+                tracer.since('parse','recv')
             await self.on_data(channel,dat)
 
         async def subscribe(self,channel):
@@ -185,6 +402,23 @@ class Streaming:
             if self.ws_connected:
                 await self.ws.close()
 
+        @staticmethod
+        def _parse_message(data):
+            channel = ''
+            dat = {}
+            if len(data)==5:
+                channel = data[1]+'-trades'
+                dat['id'] = data[0]
+                dat['pair'] = data[1]
+                dat['rate'] = float(data[2])
+                dat['amount'] = float(data[3])
+                dat['order_type'] = data[4]
+            elif len(data)==2:
+                channel = data[0]+'-orderbook'
+                dat['asks'] = [ [float(b[0]),float(b[1])] for b in data[1].get('asks',[])]
+                dat['bids'] = [ [float(b[0]),float(b[1])] for b in data[1].get('bids',[])]
+            return channel, dat
+
         async def _run_loop(self):
             async with aiohttp.ClientSession() as client:
                 self.ws = await client.ws_connect('wss://ws-api.coincheck.com/')
@@ -194,20 +428,13 @@ class Streaming:
                 while True:
                     msg = await self.ws.receive()
                     if msg.type == aiohttp.WSMsgType.TEXT:
-                        data = json.loads(msg.data)
-                        channel = ''
-                        dat = {}
-                        if len(data)==5:
-                            channel = data[1]+'-trades'
-                            dat['id'] = data[0]
-                            dat['pair'] = data[1]
-                            dat['rate'] = float(data[2])
-                            dat['amount'] = float(data[3])
-                            dat['order_type'] = data[4]
-                        elif len(data)==2:
-                            channel = data[0]+'-orderbook'
-                            dat['asks'] = [ [float(b[0]),float(b[1])] for b in data[1].get('asks',[])]
-                            dat['bids'] = [ [float(b[0]),float(b[1])] for b in data[1].get('bids',[])]
+                        if tracer.enabled:
+                            tracer.mark('recv')
+                        if self.recorder:
+                            self._record(Streaming.Recorder.WS_MESSAGE, msg.data.encode())
+                        channel, dat = self._parse_message(json.loads(msg.data))
+                        if tracer.enabled:
+                            tracer.since('parse','recv')
                         await self.on_data(channel,dat)
                     elif msg.type == aiohttp.WSMsgType.CLOSED:
                         self.ws_connected = False
@@ -218,6 +445,173 @@ class Streaming:
                         self.logger.info('wss error')
                         break
 
+    class HedgedSource(Source):
+        """複数のソースを同時に接続し、先着したデータだけを配信する
+
+        約定はID、板差分は内容で重複を判定する。
+        """
+
+        def __init__(self, *sources, window=10000):
+            super().__init__()
+            self.sources = list(sources) or [Streaming.SocketioSource(), Streaming.WebsocketSource()]
+            self.window = window
+            self.channels = set()
+            self.seen = OrderedDict()
+            # ソースごとの接続状態
+            self.source_connected = [False] * len(self.sources)
+            self.stats = [dotdict({
+                'name':type(s).__name__,
+                'first':0,
+                'second':0,
+                'led':0,
+                'lead':0.0,
+                'max_lead':0.0,
+            }) for s in self.sources]
+
+        @staticmethod
+        def _key(channel, data):
+            if isinstance(data,list):
+                return (channel,) + tuple(t['id'] for t in data)
+            if 'id' in data:
+                return (channel, data['id'])
+            return (channel, repr(data))
+
+        def _source_on_data(self, i):
+            async def on_data(channel, data):
+                now = monotonic()
+                key = self._key(channel, data)
+                first = self.seen.pop(key, None)
+                if first is None or first[0] == i:
+                    # 先着
+                    self.seen[key] = (i, now)
+                    if len(self.seen) > self.window:
+                        self.seen.popitem(last=False)
+                    self.stats[i].first += 1
+                    await self.on_data(channel, data)
+                else:
+                    # 後着は捨てて先着ソースのリードを記録
+                    lead = now - first[1]
+                    st = self.stats[first[0]]
+                    st.led += 1
+                    st.lead += lead
+                    st.max_lead = max(st.max_lead, lead)
+                    self.stats[i].second += 1
+            return on_data
+
+        @property
+        def recorder(self):
+            return self._recorder
+
+        @recorder.setter
+        def recorder(self, recorder):
+            # 受信フレームは各ソースで記録する
+            self._recorder = recorder
+            for source in getattr(self, 'sources', []):
+                source.recorder = recorder
+
+        def _source_on_connect(self, i):
+            async def on_connect():
+                if any(self.source_connected):
+                    # 既に他のソースで接続済みなら、このソースだけ購読
+                    self.source_connected[i] = True
+                    for channel in self.channels:
+                        await self.sources[i].subscribe(channel)
+                else:
+                    # 全ソース切断からの接続 (初回または再接続)
+                    self.source_connected[i] = True
+                    await self.on_connect()
+            return on_connect
+
+        def _source_on_disconnect(self, i):
+            async def on_disconnect():
+                self.source_connected[i] = False
+                if not any(self.source_connected):
+                    self.disconnected_at = monotonic()
+            return on_disconnect
+
+        def summary(self):
+            return [dict(st, mean_lead=st.lead/st.led if st.led else 0) for st in self.stats]
+
+        async def subscribe(self,channel):
+            self.channels.add(channel)
+            for source in self.sources:
+                await source.subscribe(channel)
+
+        async def unsubscribe(self,channel):
+            self.channels.discard(channel)
+            for source in self.sources:
+                await source.unsubscribe(channel)
+
+        async def start(self, on_data, on_connect, logger):
+            self.on_data = on_data
+            self.on_connect = on_connect
+            self.logger = logger
+            self.running = True
+            for i, source in enumerate(self.sources):
+                source.recorder = self.recorder
+                source.on_disconnect = self._source_on_disconnect(i)
+            await asyncio.gather(*[source.start(self._source_on_data(i),self._source_on_connect(i),logger)
+                for i, source in enumerate(self.sources)])
+
+        async def stop(self):
+            self.running = False
+            for source in self.sources:
+                await source.stop()
+
+    class ReplaySource(Source):
+        """記録したフレームを再生するソース
+
+        speed: 1なら等速、Nなら N 倍速、None(0)なら最速で再生
+        """
+
+        def __init__(self, path, speed=1.0):
+            super().__init__()
+            self.path = path
+            self.speed = speed
+            self.count = 0
+            self.elapsed = 0
+
+        def _parse(self, kind, payload):
+            if kind == Streaming.Recorder.SIO_TRADES:
+                return Streaming.SocketioSource._parse_trades(json.loads(payload))
+            elif kind == Streaming.Recorder.SIO_ORDERBOOK:
+                return Streaming.SocketioSource._parse_orderbook(json.loads(payload))
+            elif kind == Streaming.Recorder.WS_MESSAGE:
+                return Streaming.WebsocketSource._parse_message(json.loads(payload))
+            return None, None
+
+        async def _run_loop(self):
+            await self.on_connect()
+            self.logger.info(f'replay {self.path} speed {self.speed or "max"}')
+            self.count = 0
+            start = monotonic()
+            base = None
+            for t, kind, payload in Streaming.Recorder.read(self.path):
+                if not self.running:
+                    break
+                if tracer.enabled:
+                    tracer.mark('recv')
+                channel, dat = self._parse(kind, payload)
+                if channel is None:
+                    continue
+                if base is None:
+                    base = t
+                if self.speed:
+                    delay = (t - base) / self.speed - (monotonic() - start)
+                    await asyncio.sleep(max(delay, 0))
+                else:
+                    # 最速でも他のタスクに実行機会を与える
+                    await asyncio.sleep(0)
+                if tracer.enabled:
+                    tracer.since('parse','recv')
+                await self.on_data(channel,dat)
+                self.count += 1
+            self.elapsed = monotonic() - start
+            rate = self.count / self.elapsed if self.elapsed > 0 else 0
+            self.logger.info(f'replay finished {self.count} messages in {self.elapsed:.3f}s ({rate:.0f} msg/s)')
+            # 再生終了で停止
+            self.running = False
+
     class Endpoint:
 
         def __init__(self):
@@ -233,6 +627,8 @@ class Streaming:
 
         async def callback(self, channel, data):
             async with self.cond:
+                if tracer.enabled:
+                    tracer.since('callback','recv')
                 self.updated = self.update(channel,data)
                 if self.updated:
                     self.cond.notify_all()
@@ -285,16 +681,119 @@ class Streaming:
             self.deq.clear()
             return data
 
+    class TradeBatch:
+        """約定の列指向バッチ (id, rate, amount, side, time)
+
+        side は buy=1 sell=-1 不明=0
+        """
+
+        SIDES = {'buy':1, 'sell':-1}
+        ORDER_TYPES = {1:'buy', -1:'sell'}
+
+        def __init__(self, id, rate, amount, side, time):
+            self.id = id
+            self.rate = rate
+            self.amount = amount
+            self.side = side
+            self.time = time
+
+        def __len__(self):
+            return len(self.rate)
+
+        def __getitem__(self, s):
+            return Streaming.TradeBatch(self.id[s], self.rate[s], self.amount[s], self.side[s], self.time[s])
+
+        def last(self):
+            return {'id':int(self.id[-1]),'rate':float(self.rate[-1]),'amount':float(self.amount[-1]),
+                'order_type':Streaming.TradeBatch.ORDER_TYPES.get(int(self.side[-1]),'')}
+
+        def to_list(self):
+            return [{'id':int(i),'rate':float(r),'amount':float(a),'order_type':Streaming.TradeBatch.ORDER_TYPES.get(int(s),'')}
+                for i,r,a,s in zip(self.id,self.rate,self.amount,self.side)]
+
+        @staticmethod
+        def from_trades(trades, t=None):
+            n = len(trades)
+            sides = Streaming.TradeBatch.SIDES
+            return Streaming.TradeBatch(
+                np.fromiter((e['id'] for e in trades), np.int64, n),
+                np.fromiter((e['rate'] for e in trades), np.float64, n),
+                np.fromiter((e['amount'] for e in trades), np.float64, n),
+                np.fromiter((sides.get(e['order_type'],0) for e in trades), np.int8, n),
+                np.full(n, time() if t is None else t))
+
+    class ColumnarEndpoint(Endpoint):
+        """約定を事前確保した型付き配列に追記するエンドポイント
+
+        fetch_data() は TradeBatch (配列のスライス) を返す。2面のバッファを
+        交互に使うので、返したスライスは次の fetch_data() まで有効。
+        溢れた約定は捨てて overflow に数える。
+        """
+
+        def __init__(self, maxlen=5000):
+            super().__init__()
+            self.logger = logging.getLogger(__name__)
+            self.maxlen = maxlen
+            self.buffers = [self._allocate(maxlen), self._allocate(maxlen)]
+            self.active = 0
+            self.count = 0
+            self.overflow = 0
+            self.reported_overflow = 0
+
+        @staticmethod
+        def _allocate(n):
+            return Streaming.TradeBatch(
+                np.zeros(n, np.int64),
+                np.zeros(n, np.float64),
+                np.zeros(n, np.float64),
+                np.zeros(n, np.int8),
+                np.zeros(n, np.float64))
+
+        def update(self, channel, data):
+            trades = data if isinstance(data,list) else [data]
+            buf = self.buffers[self.active]
+            now = time()
+            sides = Streaming.TradeBatch.SIDES
+            for e in trades:
+                i = self.count
+                if i >= self.maxlen:
+                    self.overflow += 1
+                    continue
+                buf.id[i] = e['id']
+                buf.rate[i] = e['rate']
+                buf.amount[i] = e['amount']
+                buf.side[i] = sides.get(e['order_type'],0)
+                buf.time[i] = now
+                self.count = i + 1
+            return True
+
+        def fetch_data(self):
+            buf = self.buffers[self.active]
+            n = self.count
+            data = Streaming.TradeBatch(buf.id[:n], buf.rate[:n], buf.amount[:n], buf.side[:n], buf.time[:n])
+            self.active ^= 1
+            self.count = 0
+            if self.overflow > self.reported_overflow:
+                self.logger.warning(f'trade buffer overflow {self.overflow-self.reported_overflow} trades dropped (total {self.overflow})')
+                self.reported_overflow = self.overflow
+            return data
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="")
     parser.add_argument("--symbol", dest='symbol', type=str, default='BTCJPY')
+    parser.add_argument("--record", dest='record', type=str, default=None)
+    parser.add_argument("--replay", dest='replay', type=str, default=None)
+    parser.add_argument("--speed", dest='speed', type=float, default=1.0)
     args = parser.parse_args()
 
     async def public_main():
         # streaming = Streaming(Streaming.WebsocketSource())
-        streaming = Streaming(Streaming.SocketioSource())
+        if args.replay:
+            streaming = Streaming(Streaming.ReplaySource(args.replay, args.speed))
+        else:
+            streaming = Streaming(Streaming.SocketioSource(), record=args.record)
         executions_ep = await streaming.get_trades_endpoint('btc_jpy')
         book_ep = await streaming.get_orderbook_endpoint('btc_jpy')
         async def poll():
@@ -306,6 +805,6 @@ if __name__ == "__main__":
                     # print(ob)
                 except Exception as e:
                     print(e)
-        await asyncio.wait([streaming.start(),poll()])
+        await asyncio.gather(streaming.start(),poll())
 
-    asyncio.get_event_loop().run_until_complete(asyncio.wait([public_main()]))
+    asyncio.run(public_main())
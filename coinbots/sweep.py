@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import itertools
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool, cpu_count, shared_memory
+from time import perf_counter
+from .streaming import Streaming
+from .backtest import Backtest
+
+# ワーカープロセスが参照する約定履歴 (共有メモリ上のビュー)
+_trades = None
+_shm = None
+
+FIELDS = ('id', 'rate', 'amount', 'side', 'time')
+
+def _attach(name, layout, n):
+    """ワーカー初期化: 共有メモリの約定履歴をコピーせずに配列として参照する"""
+    global _trades, _shm
+    _shm = shared_memory.SharedMemory(name=name)
+    columns = {field:np.ndarray(n, dtype=np.dtype(dtype), buffer=_shm.buf, offset=offset)
+        for field, dtype, offset in layout}
+    _trades = Streaming.TradeBatch(**columns)
+    logging.getLogger().setLevel(logging.WARNING)
+
+def _run(job):
+    factory, params, options = job
+    strategy = factory(**params)
+    strategy.settings.columnar_executions = True
+    backtest = Backtest(strategy, **options)
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        results = loop.run_until_complete(backtest.run(_trades))
+    finally:
+        loop.close()
+    return dict(params, **results)
+
+class Sweep:
+    """パラメータの組み合わせごとのバックテストをプロセスプールで並列実行する
+
+    約定履歴は共有メモリに一度だけ置き、各ワーカーはコピーせずに参照する。
+    factory はパラメータを受け取って Strategy を返す、モジュールレベルの関数。
+    """
+
+    def __init__(self, factory, trades, processes=None, **options):
+        self.logger = logging.getLogger(__name__)
+        self.factory = factory
+        self.trades = trades
+        self.processes = processes or cpu_count()
+        self.options = options
+
+    @staticmethod
+    def grid(**params):
+        """{'name':[値,...]} の全組み合わせ"""
+        keys = list(params.keys())
+        return [dict(zip(keys, values)) for values in itertools.product(*params.values())]
+
+    def _share(self):
+        layout = []
+        offset = 0
+        for field in FIELDS:
+            a = getattr(self.trades, field)
+            # 各列を8バイト境界に揃える
+            offset = (offset + 7) // 8 * 8
+            layout.append((field, a.dtype.str, offset))
+            offset += a.nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for field, dtype, offset in layout:
+            a = getattr(self.trades, field)
+            np.ndarray(len(a), dtype=a.dtype, buffer=shm.buf, offset=offset)[:] = a
+        return shm, layout
+
+    def run(self, params):
+        """params: パラメータの辞書のリスト 結果を DataFrame で返す"""
+        start = perf_counter()
+        shm, layout = self._share()
+        try:
+            jobs = [(self.factory, p, self.options) for p in params]
+            with Pool(self.processes, initializer=_attach, initargs=(shm.name, layout, len(self.trades))) as pool:
+                results = pool.map(_run, jobs, chunksize=1)
+        finally:
+            shm.close()
+            shm.unlink()
+        elapsed = perf_counter() - start
+        self.logger.info(f'sweep {len(params)} runs in {elapsed:.3f}s with {self.processes} processes')
+        return pd.DataFrame(results)
+
+if __name__ == "__main__":
+    import argparse
+    import sys, os
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from btcmm import create_strategy
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', nargs='?', help='Streaming.Recorder のログ (省略時はランダムウォーク)')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    logging.getLogger('coinbots.strategy').setLevel(logging.WARNING)
+    logging.getLogger('coinbots.inventory').setLevel(logging.WARNING)
+
+    if args.path:
+        trades = Backtest.load_recording(args.path)
+    else:
+        # 6時間分のランダムウォーク
+        trades = Backtest.random_trades(120000, 21600)
+
+    params = Sweep.grid(
+        devlen=[10, 20],
+        devmaxlen=[300, 1000],
+        maxsize=[0.005, 0.01],
+        minimum_interval=[5, 10],
+        interval=[5])
+    sweep = Sweep(create_strategy, trades, args.processes)
+    df = sweep.run(params)
+    pd.set_option('display.width', 200)
+    print(df.sort_values('pnl', ascending=False).to_string(index=False))
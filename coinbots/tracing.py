@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from collections import defaultdict
+from time import perf_counter
+
+class Histogram:
+    """HDR風の対数線形ヒストグラム
+
+    値はマイクロ秒の整数で、上位 SUB_BITS+1 ビットを残して丸めた値を
+    バケットにする (相対誤差 1/2**SUB_BITS 以下)。
+    """
+
+    SUB_BITS = 5
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def record(self, us):
+        us = max(int(us), 0)
+        shift = us.bit_length() - Histogram.SUB_BITS - 1
+        key = (us >> shift) << shift if shift > 0 else us
+        self.counts[key] += 1
+        if self.count == 0 or us < self.min:
+            self.min = us
+        if us > self.max:
+            self.max = us
+        self.count += 1
+        self.total += us
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        rank = p / 100 * self.count
+        cum = 0
+        for key in sorted(self.counts):
+            cum += self.counts[key]
+            if cum >= rank:
+                return min(key, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count':self.count,
+            'min':self.min,
+            'mean':self.total/self.count if self.count else 0,
+            'p50':self.percentile(50),
+            'p90':self.percentile(90),
+            'p99':self.percentile(99),
+            'p999':self.percentile(99.9),
+            'max':self.max,
+        }
+
+class Tracer:
+    """処理段階ごとのレイテンシ計測
+
+    enabled が False の間は呼び出し側で何もしない。
+    mark() で時刻を記録し、since() で記録時刻からの経過をヒストグラムに加える。
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.enabled = False
+        self.histograms = defaultdict(Histogram)
+        self.marks = {}
+
+    def record(self, stage, seconds):
+        self.histograms[stage].record(seconds*1e6)
+
+    def mark(self, name, t=None):
+        self.marks[name] = perf_counter() if t is None else t
+
+    def since(self, stage, name, t=None):
+        start = self.marks.get(name)
+        if start is not None:
+            self.record(stage, (perf_counter() if t is None else t) - start)
+
+    def snapshot(self, reset=False):
+        """ステージ名 -> 統計値(マイクロ秒) の辞書を返す"""
+        result = {stage:h.summary() for stage, h in self.histograms.items()}
+        if reset:
+            self.histograms.clear()
+        return result
+
+    def summary_line(self, snapshot):
+        return ' '.join(f'{stage} n={s["count"]} p50={s["p50"]/1000:.2f} p99={s["p99"]/1000:.2f} max={s["max"]/1000:.2f}'
+            for stage, s in sorted(snapshot.items()))
+
+    async def report(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                snapshot = self.snapshot(reset=True)
+                if len(snapshot):
+                    self.logger.info('LATENCY(ms) ' + self.summary_line(snapshot))
+            except Exception as e:
+                self.logger.exception(e)
+
+tracer = Tracer()
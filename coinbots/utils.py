@@ -14,6 +14,25 @@ class dotdict(dict):
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
 
+class compensated_sum:
+    """補正付きの逐次加算 (Neumaier法)"""
+    def __init__(self, value=0.0):
+        self.sum = float(value)
+        self.c = 0.0
+
+    def add(self, x):
+        t = self.sum + x
+        if abs(self.sum) >= abs(x):
+            self.c += (self.sum - t) + x
+        else:
+            self.c += (x - t) + self.sum
+        self.sum = t
+        return self
+
+    @property
+    def value(self):
+        return self.sum + self.c
+
 def stop_watch(func):
     @wraps(func)
     def wrapper(*args, **kargs):